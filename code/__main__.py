@@ -1,34 +1,171 @@
 from __future__ import print_function
-from data_in import read_data
-from sys import argv
+from argparse import ArgumentParser
+from checkpoint import Checkpoint
+from data_in import ego_net_files, read_ego_net
 from dendrogram import Dendrogram
+from itertools import chain
 from modularity import find_best_splits
+from multiprocessing import Pool
+from profiling import Profiler, TRACE_FORMATS
+import os
+
+
+def analyze(uid, ego_net, checkpoint, source_workers=1, resume=False, options=None,
+            trace=None):
+    """
+        Finds the best clustering for one ego network, spreading its
+        betweenness passes over source_workers processes. Progress is saved
+        to checkpoint, and with resume set the build carries on from the
+        last dendrogram snapshot there, if any. options holds the keyword
+        arguments for building the dendrogram: dag_budget, stop_drop,
+        max_levels, hops, sample and seed, see Dendrogram; a resumed build
+        keeps the hops, sample and seed it was started with. trace holds
+        the directory, format and progress settings of the profiler the
+        dendrogram is built with, see profiling.Profiler; with a directory,
+        the trace is written to <uid>.trace.jsonl or <uid>.trace.json there.
+
+        Returns
+        -------
+        (uid, line) where line is the ego network's row of submission.csv
+    """
+    print("Analyzing ego network {0}".format(uid))
+    snapshot = checkpoint.snapshotter(uid)
+    options = options or {}
+    trace = trace or {}
+    out = None
+    if trace.get('directory'):
+        out = open(os.path.join(trace['directory'],
+                                "{0}.trace.{1}".format(uid, TRACE_FORMATS[trace['format']])),
+                   'w')
+    profiler = Profiler(out, trace.get('format', 'jsonl'), trace.get('progress', False))
+    dendrogram = checkpoint.load_dendrogram(uid) if resume else None
+    if dendrogram:
+        kept = ('hops', 'sample', 'seed')
+        dendrogram.resume(source_workers, snapshot, profiler=profiler,
+                          **dict((name, value) for name, value in options.iteritems()
+                                 if name not in kept))
+    else:
+        dendrogram = Dendrogram(ego_net, workers=source_workers, checkpoint=snapshot,
+                                profiler=profiler, **options)
+    profiler.close()
+    size = ego_net.size
+    best_split = int(find_best_splits(dendrogram.levels, size))
+    circles = dendrogram.convert_to_circles()[best_split]
+    circ_str = str(uid) + "," + str(len(circles)) + ","
+    circ_str += ";".join([" ".join([str(fid) for fid in circle]) for circle in circles])
+    checkpoint.save_result(uid, circ_str, circles, best_split)
+    print("Best split level for ego network {0} is {1}".format(uid, best_split))
+    return uid, circ_str
+
+
+def analyze_file(task):
+    """
+        Worker entry point: reads in the ego network itself, so that only
+        file names and output lines cross between processes.
+    """
+    egonet_path, file_name, cache_dir, checkpoint, resume, options, trace = task
+    uid, ego_net = read_ego_net(egonet_path, file_name, cache_dir)
+    return analyze(uid, ego_net, checkpoint, resume=resume, options=options, trace=trace)
+
+
+def write_in_order(results, uids, out):
+    """
+        Writes the lines from results, which may come in any order, to out
+        in the order of uids. Each line is written as soon as every line
+        before it has arrived.
+    """
+    pending = {}
+    index = 0
+    for uid, line in results:
+        pending[uid] = line
+        while index < len(uids) and uids[index] in pending:
+            print(pending.pop(uids[index]), file=out)
+            out.flush()
+            index += 1
+
 
 if __name__ == "__main__":
     """
         Finds the best clustering for each of the given ego network files.
-        Stores output to file called submission.csv
+        Stores output to file called submission.csv, ordered by uid
     """
-    ego_nets = read_data(argv[1])
+    parser = ArgumentParser(description="Finds the best clustering for each ego network")
+    parser.add_argument("egonet_path", help="directory containing .egonet files")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of ego networks to analyze in parallel")
+    parser.add_argument("--source-workers", type=int, default=1,
+                        help="number of processes to split the betweenness "
+                             "sources of a single ego network over")
+    parser.add_argument("--checkpoint-dir", default="checkpoints",
+                        help="directory to save progress to")
+    parser.add_argument("--snapshot-interval", type=float, default=60,
+                        help="seconds between snapshots of a dendrogram being built")
+    parser.add_argument("--cache-dir", default="egonet_cache",
+                        help="directory to keep parsed ego networks in")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the ego networks finished by an earlier run "
+                             "and continue any partly built dendrograms")
+    parser.add_argument("--dag-budget", type=float,
+                        help="megabytes of shortest path distances to keep per "
+                             "ego network, no limit by default")
+    parser.add_argument("--stop-drop", type=float,
+                        help="stop splitting an ego network once modularity is "
+                             "this far below the best level so far")
+    parser.add_argument("--max-levels", type=int,
+                        help="stop splitting an ego network after this many levels")
+    parser.add_argument("--hops", type=int,
+                        help="only count shortest paths of up to this many edges in "
+                             "betweenness, a faster local approximation")
+    parser.add_argument("--sample", type=float, nargs=2, metavar=("EPSILON", "DELTA"),
+                        help="estimate betweenness from a sample of the sources, "
+                             "within EPSILON * n * (n - 1) with probability 1 - DELTA")
+    parser.add_argument("--seed", type=int, help="seed for --sample")
+    parser.add_argument("--trace-dir",
+                        help="directory to write a trace of each dendrogram build to")
+    parser.add_argument("--trace-format", choices=TRACE_FORMATS.keys(), default="jsonl",
+                        help="JSON lines, or the Chrome trace event format")
+    parser.add_argument("--progress", action="store_true",
+                        help="print the progress of each dendrogram level")
+    args = parser.parse_args()
+    if args.workers > 1 and args.source_workers > 1:
+        parser.error("--workers and --source-workers can't be combined")
+    checkpoint = Checkpoint(args.checkpoint_dir, args.snapshot_interval)
+    options = {'dag_budget': args.dag_budget * 2 ** 20 if args.dag_budget is not None else None,
+               'stop_drop': args.stop_drop, 'max_levels': args.max_levels,
+               'hops': args.hops, 'sample': args.sample, 'seed': args.seed}
+    trace = {'directory': args.trace_dir, 'format': args.trace_format,
+             'progress': args.progress}
+    if args.trace_dir and not os.path.isdir(args.trace_dir):
+        os.makedirs(args.trace_dir)
+    if args.cache_dir and not os.path.isdir(args.cache_dir):
+        os.makedirs(args.cache_dir)
+
+    def finished(uid):
+        return args.resume and checkpoint.done(uid)
 
-    # Good sets (small) to test on are 25708, and 1310
-    # Change this variable to change the egonet that it starts reading from
-    # start = 8338
-    # index = [k for k, v in tup_ls].index(start)
-    index = 0  # use the line above instead if not running from start
-    tup_ls = sorted(ego_nets.iteritems(), key=lambda t: t[1].size)
     out = open("submission.csv", "w")
-    # out = open("out.txt", "a")  # if not running from start, use append instead
-    while index < len(tup_ls):
-        uid, ego_net = tup_ls[index]
-        print("Analyzing ego network {0}".format(uid))
-        dendrogram = Dendrogram(ego_net)
-        size = ego_net.size
-        best_split = find_best_splits(dendrogram.levels, size)
-        circles = dendrogram.convert_to_circles()[best_split]
-        circ_str = str(uid) + "," + str(len(circles)) + ","
-        circ_str += ";".join([" ".join([str(fid) for fid in circle]) for circle in circles])
-        print(circ_str, file=out)
-        print("Best split level for ego network {0} is {1}".format(uid, best_split))
-        index += 1
+    files = ego_net_files(args.egonet_path, largest_first=args.workers > 1)
+    uids = sorted(uid for uid, file_name, file_size in files)
+    done = [checkpoint.load_result(uid) for uid in uids if finished(uid)]
+    if args.workers > 1:
+        # Hand out the largest ego networks first, one at a time, so that
+        # the big ones don't end up as the tail of the run
+        pool = Pool(args.workers)
+        tasks = [(args.egonet_path, file_name, args.cache_dir, checkpoint, args.resume,
+                  options, trace)
+                 for uid, file_name, file_size in files if not finished(uid)]
+        results = pool.imap_unordered(analyze_file, tasks)
+        write_in_order(chain(done, results), uids, out)
+        pool.close()
+        pool.join()
+    else:
+        # Good sets (small) to test on are 25708, and 1310
+        # The unfinished ego networks are read in one at a time, smallest
+        # first, as they're needed
+        ego_nets = (read_ego_net(args.egonet_path, file_name, args.cache_dir)
+                    for uid, file_name, file_size in files if not finished(uid))
+        results = (analyze(uid, ego_net, checkpoint, args.source_workers, args.resume,
+                           options, trace)
+                   for uid, ego_net in ego_nets)
+        write_in_order(chain(done, results), uids, out)
     out.close()
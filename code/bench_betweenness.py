@@ -0,0 +1,42 @@
+from __future__ import print_function
+from betweenness import edge_betweenness, tree_edge_betweenness
+from data_in import add_friends, map_graph
+from sys import argv
+import numpy as np
+import os
+import time
+
+
+def load(path):
+    adj_list = {}
+    with open(path) as handle:
+        for line in handle:
+            add_friends(adj_list, line)
+    return map_graph(adj_list)
+
+
+def timed(function, graph):
+    start = time.time()
+    scores = function(graph)
+    return time.time() - start, scores
+
+
+if __name__ == "__main__":
+    """
+        Times one full edge betweenness pass with the Brandes engine against
+        the ShortestPathTree reference on each of the given ego networks.
+
+        Usage: python code/bench_betweenness.py path/to/egonets/ [uid ...]
+        With no uids, the small 1310 and 25708 ego networks are used.
+    """
+    egonet_path = argv[1]
+    uids = argv[2:] or ['1310', '25708']
+    print("{0:>8} {1:>6} {2:>7} {3:>10} {4:>10} {5:>8} {6:>10}".format(
+        "egonet", "|V|", "|E|", "tree (s)", "brandes (s)", "speedup", "max diff"))
+    for uid in uids:
+        graph = load(os.path.join(egonet_path, uid + ".egonet"))
+        tree_time, tree_scores = timed(tree_edge_betweenness, graph)
+        brandes_time, (brandes_scores, dist) = timed(edge_betweenness, graph)
+        print("{0:>8} {1:>6} {2:>7} {3:>10.3f} {4:>10.3f} {5:>7.1f}x {6:>10.2e}".format(
+            uid, len(graph.ids), graph.size, tree_time, brandes_time,
+            tree_time / brandes_time, np.abs(tree_scores - brandes_scores).max()))
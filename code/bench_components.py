@@ -0,0 +1,63 @@
+from __future__ import print_function
+from bench_betweenness import load
+from itertools import combinations
+from sys import argv
+import os
+import time
+
+
+def pairwise_components(graph):
+    """
+        Reference component search: tests pairs of vertices for a path
+        between them, last pair first, and splits off the first vertex's
+        component whenever there is none. Quadratic in the number of
+        vertices; kept to check and benchmark Graph.components against.
+
+        Returns:
+        -------
+        list of the vertex ids of each component
+    """
+    found = []
+    pairs = list(combinations(graph.ids, 2))
+    while pairs:
+        i, j = pairs.pop()
+        is_connected, children = graph.connected_components(i, j)
+        if not is_connected:
+            left, graph = children
+            found.append(left.ids)
+            pairs = list(combinations(graph.ids, 2))
+    found.append(graph.ids)
+    return found
+
+
+def timed(function, graph):
+    start = time.time()
+    result = function(graph)
+    return time.time() - start, result
+
+
+if __name__ == "__main__":
+    """
+        Times splitting each of the given ego networks into its connected
+        components with Graph.components against the pairwise search.
+
+        Usage: python code/bench_components.py path/to/egonets/ [uid ...]
+        With no uids, the three largest ego networks in the directory are
+        used.
+    """
+    egonet_path = argv[1]
+    uids = argv[2:]
+    if not uids:
+        files = sorted(os.listdir(egonet_path),
+                       key=lambda name: os.path.getsize(os.path.join(egonet_path, name)))
+        uids = [name.split('.')[0] for name in files[-3:]]
+    print("{0:>8} {1:>6} {2:>7} {3:>6} {4:>13} {5:>13} {6:>8} {7:>6}".format(
+        "egonet", "|V|", "|E|", "parts", "pairwise (s)", "one pass (s)", "speedup", "same"))
+    for uid in uids:
+        graph = load(os.path.join(egonet_path, uid + ".egonet"))
+        pairwise_time, pairwise = timed(pairwise_components, graph)
+        one_pass_time, components = timed(lambda graph: graph.components(), graph)
+        same = pairwise == [component.ids for component in components]
+        print("{0:>8} {1:>6} {2:>7} {3:>6} {4:>13.3f} {5:>13.3f} {6:>7.0f}x {7:>6}".format(
+            uid, len(graph.ids), graph.size, len(components), pairwise_time,
+            one_pass_time, pairwise_time / one_pass_time, str(same)))
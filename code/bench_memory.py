@@ -0,0 +1,99 @@
+from __future__ import print_function
+from bench_betweenness import load
+from betweenness import edge_betweenness
+from dendrogram import Dendrogram
+from shortest_path_tree import ShortestPathTree
+from sys import argv
+import gc
+import numpy as np
+import os
+import sys
+import time
+
+
+def footprint(obj):
+    """
+        Bytes taken up by obj, its __dict__ if it has one, and the lists,
+        dicts and arrays it holds directly (one level of nested dicts
+        included). The objects those containers point to are not counted
+    """
+    if hasattr(obj, '__dict__'):
+        values = obj.__dict__.values()
+        total = sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+    else:
+        values = [getattr(obj, name, None) for name in obj.__slots__]
+        total = sys.getsizeof(obj)
+    for value in values:
+        if isinstance(value, (list, dict, np.ndarray)):
+            total += sys.getsizeof(value)
+        if isinstance(value, dict):
+            total += sum(sys.getsizeof(inner) for inner in value.itervalues()
+                         if isinstance(inner, dict))
+    return total
+
+
+def measure(objects):
+    """
+        Returns:
+        -------
+        (count, total bytes, bytes per object) over objects
+    """
+    objects = list(objects)
+    total = sum(footprint(obj) for obj in objects)
+    return len(objects), total, total / max(len(objects), 1)
+
+
+def tree_nodes(graph):
+    """
+        Builds a ShortestPathTree from every vertex, as one pass of
+        tree_edge_betweenness does
+
+        Returns:
+        -------
+        (seconds taken, gc tracked objects added, nodes of every tree)
+    """
+    gc.collect()
+    tracked = len(gc.get_objects())
+    start = time.time()
+    trees = [ShortestPathTree(v, graph) for v in graph.ids]
+    elapsed = time.time() - start
+    added = len(gc.get_objects()) - tracked
+    nodes = [node for tree in trees for node in tree.tree_dict if node is not None]
+    return elapsed, added, nodes
+
+
+def report(name, count, total, per_object):
+    print("{0:>24} {1:>9} {2:>12} {3:>10.1f}".format(name, count, total, per_object))
+
+
+if __name__ == "__main__":
+    """
+        Reports the memory taken up by the per-vertex and per-node objects
+        built while analyzing each of the given ego networks: the nodes of
+        one full set of shortest path trees, the graph's vertices once their
+        pair betweennesses are filled in, and the dendrogram's nodes.
+
+        Usage: python code/bench_memory.py path/to/egonets/ [uid ...]
+        With no uids, the small 1310 and 25708 ego networks are used.
+    """
+    egonet_path = argv[1]
+    uids = argv[2:] or ['1310', '25708']
+    for uid in uids:
+        graph = load(os.path.join(egonet_path, uid + ".egonet"))
+        print("ego network {0}: {1} vertices, {2} edges".format(uid, len(graph.ids), graph.size))
+        print("{0:>24} {1:>9} {2:>12} {3:>10}".format("objects", "count", "bytes", "bytes/obj"))
+        elapsed, added, nodes = tree_nodes(graph)
+        report("shortest path tree nodes", *measure(nodes))
+        dendrogram = Dendrogram(graph.clone())
+        # Pair betweennesses are only defined within a connected component
+        component = max(dendrogram.levels[1], key=lambda node: len(node.graph.ids)).graph.clone()
+        component.scores, component.dist = edge_betweenness(component)
+        vertices = [component.vertices[v] for v in component.ids]
+        report("vertices (reset)", *measure(vertices))
+        for vertex in vertices:
+            component.set_pair_betweenness(vertex)
+        report("vertices (pair scores)", *measure(vertices))
+        report("dendrogram nodes", *measure(
+            node for level in dendrogram.levels.values() for node in level))
+        print("shortest path trees built in {0:.3f}s, adding {1} gc tracked objects\n".format(
+            elapsed, added))
@@ -0,0 +1,185 @@
+from __future__ import print_function
+from argparse import ArgumentParser
+from collections import OrderedDict, defaultdict
+from itertools import combinations
+from data_in import add_friends, map_graph
+from dendrogram import Dendrogram, Node
+from graph import Graph, Vertex
+from modularity import find_best_splits
+from multiprocessing import Pool
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+
+BUCKETS = OrderedDict([('small', ['1310', '25708']),
+                       ('medium', ['8338']),
+                       ('large', ['6934', '5881'])])
+
+# (phase, class, method) for the phases timed within the dendrogram build.
+# set_split_bound, set_pair_betweenness and set_split_betweenness all count
+# as the split betweenness of a vertex
+PHASES = [('e_betweenness', Node, 'calculate_e_betweenness'),
+          ('remove_edge', Node, 'remove_edge'),
+          ('split_betweenness', Graph, 'set_split_bound'),
+          ('split_betweenness', Graph, 'set_pair_betweenness'),
+          ('split_betweenness', Vertex, 'set_split_betweenness'),
+          ('connected_components', Graph, 'connected_components')]
+
+
+def timed_phase(phases, name, function):
+    """Wraps function to add its calls and seconds to phases[name]"""
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            phases[name][0] += 1
+            phases[name][1] += time.time() - start
+    return wrapper
+
+
+def run(task):
+    """
+        Runs the whole pipeline on one ego network, timing each phase. Meant
+        to run in a process of its own, as it patches the timed methods and
+        reports the peak memory of the process
+
+        Returns:
+        -------
+        dict of the results, ready to be written out as JSON
+    """
+    egonet_path, bucket, uid, mode, options = task
+    phases = defaultdict(lambda: [0, 0.0])
+    for name, cls, method in PHASES:
+        setattr(cls, method, timed_phase(phases, name, getattr(cls, method)))
+    start = time.time()
+    adj_list = {}
+    with open(os.path.join(egonet_path, uid + ".egonet")) as handle:
+        for line in handle:
+            add_friends(adj_list, line)
+    phases['load'] = [1, time.time() - start]
+    graph = timed_phase(phases, 'map_graph', map_graph)(adj_list)
+    dendrogram = timed_phase(phases, 'dendrogram', Dendrogram)(graph, **options)
+    best_split = timed_phase(phases, 'modularity', find_best_splits)(dendrogram.levels,
+                                                                     graph.size)
+    return {'uid': uid, 'bucket': bucket, 'mode': mode, 'vertices': len(graph.ids),
+            'edges': graph.size, 'levels': len(dendrogram.levels),
+            'best_split': int(best_split),
+            'modularity': float(dendrogram.modularity.qs[int(best_split)]),
+            'circles': dendrogram.convert_to_circles()[int(best_split)],
+            'total_seconds': time.time() - start,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'phases': dict((name, {'calls': calls, 'seconds': seconds})
+                           for name, (calls, seconds) in phases.iteritems())}
+
+
+def agreement(circles, reference):
+    """
+        Rand index between two clusterings: the share of the pairs of
+        vertices that are either in a circle together in both, or in none
+        together in either
+    """
+    def together(circles):
+        return set(pair for circle in circles for pair in combinations(sorted(set(circle)), 2))
+    vertices = set(v for circle in circles + reference for v in circle)
+    pairs = len(vertices) * (len(vertices) - 1) / 2.0
+    return 1 - len(together(circles) ^ together(reference)) / pairs if pairs else 1.0
+
+
+def commit():
+    """The git commit being benchmarked, if there is one"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(result):
+    phases = result['phases']
+    print("{0:>8} {1:>7} {2:>7} {3:>6} {4:>7} {5:>7} {6:>9.3f} {7:>9.1f} {8:>6.3f} {9:>6}".format(
+        result['uid'], result['bucket'], result['mode'], result['vertices'], result['edges'],
+        result['levels'], result['total_seconds'], result['peak_rss_mb'],
+        result['modularity'], "{0:.3f}".format(result['agreement'])
+        if 'agreement' in result else '-'))
+    for name in ['load', 'map_graph', 'dendrogram', 'e_betweenness', 'remove_edge',
+                 'split_betweenness', 'connected_components', 'modularity']:
+        if name in phases:
+            print("{0:>31} {1:>9} calls {2:>9.3f}s".format(
+                name, phases[name]['calls'], phases[name]['seconds']))
+
+
+if __name__ == "__main__":
+    """
+        Benchmarks the whole pipeline, from reading an ego network to
+        picking its best split, over ego networks bucketed by size. Reports
+        the time taken by each phase and the peak memory of each ego
+        network, and with --output writes the results as JSON, tagged with
+        the commit, to compare runs across commits. Each ego network is run
+        in a fresh process so that its peak memory is its own.
+
+        With --hops, each ego network is also run with betweenness limited
+        to shortest paths of each of the given lengths, and with --sample,
+        with betweenness estimated from sampled sources. Those runs report
+        how well their best split agrees with the exact one, as the Rand
+        index over pairs of vertices. Every run reports the modularity of
+        its best split.
+
+        The dendrogram phase is the whole build; e_betweenness, remove_edge,
+        split_betweenness and connected_components are the parts of it
+        spent in those methods. e_betweenness counts every full recompute,
+        including the ones remove_edge falls back to, so the two overlap.
+
+        Usage: python code/bench_pipeline.py Data/egonets/ [--buckets small medium]
+            [--uids uid ...] [--hops h ...] [--sample epsilon delta]
+            [--seed seed] [--output bench.json]
+    """
+    parser = ArgumentParser(description="Benchmarks the pipeline over bucketed ego networks")
+    parser.add_argument("egonet_path", help="directory containing .egonet files")
+    parser.add_argument("--buckets", nargs="+", choices=BUCKETS.keys(),
+                        default=['small', 'medium'], help="size buckets to run")
+    parser.add_argument("--uids", nargs="+", help="ego networks to run instead of the buckets")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--stop-drop", type=float, help="see Dendrogram")
+    parser.add_argument("--max-levels", type=int, help="see Dendrogram")
+    parser.add_argument("--hops", type=int, nargs="+", default=[],
+                        help="path length limits to compare against exact betweenness")
+    parser.add_argument("--sample", type=float, nargs=2, metavar=("EPSILON", "DELTA"),
+                        help="sampling error bound to compare against exact betweenness")
+    parser.add_argument("--seed", type=int, default=0, help="seed for --sample")
+    args = parser.parse_args()
+    options = {'stop_drop': args.stop_drop, 'max_levels': args.max_levels}
+    modes = [('exact', options)] + [("hops={0}".format(hops), dict(options, hops=hops))
+                                    for hops in args.hops]
+    if args.sample:
+        modes.append(("sample", dict(options, sample=args.sample, seed=args.seed)))
+    if args.uids:
+        egonets = [('custom', uid) for uid in args.uids]
+    else:
+        egonets = [(bucket, uid) for bucket in args.buckets for uid in BUCKETS[bucket]]
+    tasks = [(args.egonet_path, bucket, uid, mode, mode_options)
+             for bucket, uid in egonets for mode, mode_options in modes]
+    print("{0:>8} {1:>7} {2:>7} {3:>6} {4:>7} {5:>7} {6:>9} {7:>9} {8:>6} {9:>6}".format(
+        "egonet", "bucket", "mode", "|V|", "|E|", "levels", "total (s)", "peak (MB)",
+        "Q", "rand"))
+    pool = Pool(1, maxtasksperchild=1)
+    results = []
+    exact = {}
+    for result in pool.imap(run, tasks):
+        circles = result.pop('circles')
+        if result['mode'] == 'exact':
+            exact[result['uid']] = circles
+        else:
+            result['agreement'] = agreement(circles, exact[result['uid']])
+        report(result)
+        results.append(result)
+    pool.close()
+    pool.join()
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump({'commit': commit(), 'python': platform.python_version(),
+                       'options': options, 'results': results}, out, indent=2, sort_keys=True)
@@ -0,0 +1,113 @@
+from __future__ import print_function
+from bench_betweenness import load
+from sys import argv
+import os
+import random
+import time
+import traversal
+
+
+def list_bfs(adjacency, source):
+    """Reference breadth first search over a list queue"""
+    visited = [False] * len(adjacency)
+    visited[source] = True
+    queue = [source]
+    order = []
+    while queue:
+        v = queue.pop(0)
+        order.append(v)
+        for k, w in adjacency[v]:
+            if not visited[w]:
+                visited[w] = True
+                queue.append(w)
+    return order
+
+
+def list_labels(adjacency, vertices):
+    """Reference component labelling, one list queue search per component"""
+    labels = [-1] * len(adjacency)
+    count = 0
+    for v in vertices:
+        if labels[v] < 0:
+            for w in list_bfs(adjacency, v):
+                labels[w] = count
+            count += 1
+    return labels
+
+
+def list_connected(adjacency, i, j):
+    """Reference connectivity check: search from i until j turns up"""
+    visited = [False] * len(adjacency)
+    visited[i] = True
+    queue = [i]
+    while queue:
+        for k, w in adjacency[queue.pop(0)]:
+            if not visited[w]:
+                if w == j:
+                    return True, None
+                visited[w] = True
+                queue.append(w)
+    return False, [v for v, seen in enumerate(visited) if seen]
+
+
+def without_edge(adjacency, i, j):
+    """A copy of adjacency with edge {i, j} taken out"""
+    adjacency = list(adjacency)
+    adjacency[i] = [(k, w) for k, w in adjacency[i] if w != j]
+    adjacency[j] = [(k, w) for k, w in adjacency[j] if w != i]
+    return adjacency
+
+
+def timed(function, cases):
+    start = time.time()
+    results = [function(*case) for case in cases]
+    return time.time() - start, results
+
+
+def report(name, reference, fast):
+    (reference_time, reference_results), (fast_time, fast_results) = reference, fast
+    print("{0:>18} {1:>13.4f} {2:>13.4f} {3:>7.1f}x {4:>6}".format(
+        name, reference_time, fast_time, reference_time / max(fast_time, 1e-9),
+        str(reference_results == fast_results)))
+
+
+if __name__ == "__main__":
+    """
+        Microbenchmarks for each traversal in traversal.py against a plain
+        list queue version, on each of the given ego networks:
+          bfs: a full search from every vertex
+          component_labels: labelling the connected components
+          connected: connectivity checks between the two ends of each edge
+              once it is taken out, as after every removal in a dendrogram.
+              The component found for a disconnected pair is compared as a
+              set
+
+        Usage: python code/bench_traversal.py path/to/egonets/ [uid ...]
+        With no uids, the small 1310 and 25708 ego networks are used.
+    """
+    egonet_path = argv[1]
+    uids = argv[2:] or ['1310', '25708']
+    random.seed(0)
+    for uid in uids:
+        graph = load(os.path.join(egonet_path, uid + ".egonet"))
+        adjacency = graph.adjacency()
+        print("ego network {0}: {1} vertices, {2} edges".format(uid, len(graph.ids), graph.size))
+        print("{0:>18} {1:>13} {2:>13} {3:>8} {4:>6}".format(
+            "traversal", "list (s)", "fast (s)", "speedup", "same"))
+        sources = [(adjacency, v) for v in graph.ids]
+        report("bfs", timed(list_bfs, sources),
+               timed(lambda adjacency, v: traversal.bfs(adjacency, v, [False] * len(adjacency)),
+                     sources))
+        cases = [(adjacency, graph.ids)] * 20
+        report("component_labels", timed(list_labels, cases),
+               timed(traversal.component_labels, cases))
+        edges = [(v, w) for v in graph.ids for k, w in adjacency[v] if v < w]
+        cases = [(without_edge(adjacency, i, j), i, j)
+                 for i, j in random.sample(edges, min(len(edges), 500))]
+        as_sets = lambda results: [(c, set(component) if component else None)
+                                   for c, component in results]
+        reference_time, reference_results = timed(list_connected, cases)
+        fast_time, fast_results = timed(traversal.connected, cases)
+        report("connected", (reference_time, as_sets(reference_results)),
+               (fast_time, as_sets(fast_results)))
+        print()
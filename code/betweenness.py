@@ -0,0 +1,314 @@
+from __future__ import division
+from collections import defaultdict, deque
+from math import ceil, log, sqrt
+from shortest_path_tree import ShortestPathTree
+import numpy as np
+
+
+# Adding and then subtracting ROUNDING rounds a non-negative float below
+# 2 ** 28 to a multiple of 2 ** -24
+ROUNDING = 2.0 ** 28
+
+# Number of sources sampled_edge_betweenness starts with
+FIRST_SAMPLE = 32
+
+
+def edge_betweenness(graph, sources=None, hops=None):
+    """
+        Brandes' algorithm for edge betweenness. One breadth first search per
+        source counts the shortest paths (sigma) to every vertex, then the
+        vertices are popped off in reverse BFS order to accumulate each
+        vertex's dependency (delta) onto the edges to its parents.
+
+        Each source's contribution to an edge is rounded to a multiple of
+        2 ** -24 before it is added in. Sums of these stay exact, so the
+        total does not depend on the order of the sources, and the
+        contribution of a source can later be taken out again exactly by
+        subtracting it.
+
+        Given hops, only shortest paths of at most that many edges are
+        counted, as in the local betweenness of CONGO (Gregory 2008): each
+        search stops hops levels out from its source.
+
+        Otherwise, sources in pendant trees are not searched from. A vertex
+        v in a tree hanging off the rest of the graph at vertex a reaches
+        everything outside its tree through a, over the one path between
+        them, so its dependency on every edge outside the tree is the same
+        as a's. On a tree edge it is the number of vertices reached on the
+        far side of the edge from v, which only differs from a's for the
+        edges on the path from v to a. a's search is counted once for
+        itself and each source in its trees, and the differences on those
+        paths are added in exactly, so the scores come out the same as with
+        a search from each.
+
+        Parameters:
+        ----------
+        graph: Graph to score
+        sources: ids of the vertices to run the search from, every vertex of
+            the graph by default
+        hops: longest shortest paths to count, no limit by default
+
+        Returns:
+        -------
+        (scores, dist): scores is an array over graph slots holding the
+            betweenness of each live edge summed over sources, the same in
+            both slots of the edge and 0 in dead slots. dist has one row per
+            source giving its distance to every vertex id, -1 if unreachable
+            (or further than hops)
+    """
+    adjacency = graph.adjacency()
+    n = len(adjacency)
+    if sources is None:
+        sources = graph.ids
+    scores = [0.0] * len(graph.indices)
+    dists = np.empty((len(sources), n), dtype=np.int32)
+    sigma = [0] * n
+    delta = [0.0] * n
+    dist = [-1] * n
+    last = hops if hops is not None else n
+    searches, pendants = pendant_sources(adjacency, sources, hops)
+    for s, rows in searches.iteritems():
+        stack = []
+        queue = deque([s])
+        sigma[s] = 1
+        dist[s] = 0
+        while queue:
+            v = queue.popleft()
+            stack.append(v)
+            d = dist[v] + 1
+            if d > last:
+                continue
+            sv = sigma[v]
+            for k, w in adjacency[v]:
+                if dist[w] < 0:
+                    dist[w] = d
+                    queue.append(w)
+                if dist[w] == d:
+                    sigma[w] += sv
+        dists[rows] = dist
+        for w in reversed(stack):
+            coeff = (1 + delta[w]) / sigma[w]
+            d = dist[w] - 1
+            for k, v in adjacency[w]:
+                if dist[v] == d:
+                    score = sigma[v] * coeff
+                    scores[k] += len(rows) * ((score + ROUNDING) - ROUNDING)
+                    delta[v] += score
+        for row, v, path, branch in pendants.get(s, ()):
+            # On the path down to s, v has all but size vertices on the far
+            # side of each edge, where s has size
+            for k, size in path:
+                scores[k] += len(stack) - 2 * size
+            # Everything past s is as far again as s is from v, and the
+            # vertices of v's branch of the tree are found by searching it
+            row_dist = dists[row]
+            row_dist[row_dist >= 0] += len(path)
+            row_dist[list(branch)] = -1
+            row_dist[v] = 0
+            queue = deque([v])
+            while queue:
+                u = queue.popleft()
+                for k, w in adjacency[u]:
+                    if w in branch and row_dist[w] < 0:
+                        row_dist[w] = row_dist[u] + 1
+                        queue.append(w)
+        for v in stack:
+            sigma[v] = 0
+            delta[v] = 0.0
+            dist[v] = -1
+    scores = np.array(scores)
+    return scores + scores[graph.twin], dists
+
+
+def pendant_sources(adjacency, sources, hops=None):
+    """
+        Plans the searches of edge_betweenness. The pendant trees are found
+        by peeling off the vertices with one edge left until none are left:
+        each vertex peeled off hangs from the one neighbour it still had,
+        down to a vertex that is never peeled off, where the tree is
+        attached. Only done without hops.
+
+        Returns:
+        -------
+        (searches, pendants): searches maps each vertex to search from to
+            the rows of dist its search fills in. pendants maps such a
+            vertex a to (row, v, path, branch) for each source v in a tree
+            attached at a. path holds (k, size) for each edge on the way
+            down from v to a, where k is its slot in the row of its end
+            further from a, and size is the number of vertices hanging
+            from that end. branch is the set of vertices hanging from the
+            same neighbour of a as v
+    """
+    searches = {}
+    pendants = {}
+    hanging = {}
+    if hops is None:
+        hanging = pendant_trees(adjacency)
+    for row, s in enumerate(sources):
+        if s in hanging:
+            a, path, branch = hanging[s]
+            searches.setdefault(a, []).append(row)
+            pendants.setdefault(a, []).append((row, s, path, branch))
+        else:
+            searches.setdefault(s, []).append(row)
+    return searches, pendants
+
+
+def pendant_trees(adjacency):
+    """
+        Returns:
+        -------
+        dict mapping each vertex in a pendant tree to (a, path, branch), as
+            for pendant_sources
+    """
+    degree = [len(edges) for edges in adjacency]
+    parent = {}
+    peeled = []
+    stack = [v for v, edges in enumerate(adjacency) if len(edges) == 1]
+    while stack:
+        v = stack.pop()
+        if degree[v] != 1:
+            continue
+        # Every neighbour but the one it hangs from is already peeled off
+        k, u = next((k, u) for k, u in adjacency[v] if u not in parent)
+        parent[v] = (k, u)
+        peeled.append(v)
+        degree[v] = 0
+        degree[u] -= 1
+        if degree[u] == 1:
+            stack.append(u)
+    # Children are peeled off before their parents
+    size = dict((v, 1) for v in peeled)
+    for v in peeled:
+        k, u = parent[v]
+        if u in parent:
+            size[u] += size[v]
+    hanging = {}
+    for v in reversed(peeled):
+        k, u = parent[v]
+        if u in parent:
+            a, path, branch = hanging[u]
+        else:
+            a, path, branch = u, [], set()
+        branch.add(v)
+        hanging[v] = (a, [(k, size[v])] + path, branch)
+    return hanging
+
+
+def sampled_edge_betweenness(graph, epsilon, delta, random, betweenness=edge_betweenness):
+    """
+        Estimates edge betweenness from a random sample of the sources,
+        scaled up to all of them (pivot sampling, Brandes and Pich 2007).
+
+        Each source adds between 0 and n - 1 to an edge, so by Hoeffding's
+        inequality and a union bound over the m edges, a sample of
+        ln(2m / delta) / (2 epsilon ** 2) sources puts every estimate within
+        epsilon * n * (n - 1) of the exact score with probability at least
+        1 - delta. That many are only drawn if need be: the sample starts at
+        FIRST_SAMPLE sources and doubles until the highest estimate is
+        ahead of every other by twice the error bound at that size, so that
+        the best edge is the exact one with probability at least 1 - delta
+        (split over the checks made), or the full sample size is reached.
+
+        Parameters:
+        ----------
+        graph: Graph to score
+        epsilon, delta: error bound, relative to n * (n - 1), and the
+            probability of exceeding it
+        random: numpy RandomState to draw the sample from
+        betweenness: function to run the searches with, taking graph and
+            the sources, edge_betweenness by default
+
+        Returns:
+        -------
+        (scores, dist, sources): scores and dist as for edge_betweenness,
+            with a row of dist per sampled source, and the ids of the
+            sources in the order of those rows. If the sample would be all
+            of the graph's vertices, the exact scores are computed instead
+            and sources is None
+    """
+    n, m = len(graph.ids), graph.size
+    checks = 1 + int(ceil(log(max(n, 2), 2)))
+    limit = int(ceil(log(2 * m / delta) / (2 * epsilon ** 2)))
+    if limit >= n:
+        scores, dist = betweenness(graph)
+        return scores, dist, None
+    order = random.permutation(graph.ids)[:limit]
+    edges = np.flatnonzero(graph.alive & (graph.owner < graph.indices))
+    scores = np.zeros(len(graph.indices))
+    rows = []
+    taken = 0
+    while taken < limit:
+        batch = order[taken:taken + max(taken, FIRST_SAMPLE)]
+        batch_scores, batch_dist = betweenness(graph, batch)
+        scores += batch_scores
+        rows.append(batch_dist)
+        taken += len(batch)
+        top = np.sort(scores[edges])[-2:] * n / taken
+        radius = n * (n - 1) * sqrt(log(2 * m * checks / delta) / (2 * taken))
+        if len(top) < 2 or top[1] - top[0] >= 2 * radius:
+            break
+    return scores * n / taken, np.concatenate(rows), order[:taken]
+
+
+def affected_sources(dist, i, j):
+    """
+        Parameters:
+        ----------
+        dist: distance matrix from a previous call to edge_betweenness over
+            every vertex of a graph, with the same hops if any
+        i, j: ids of the two endpoints of an edge
+
+        Returns:
+        -------
+        rows of dist, that is positions in the graph's ids, of the sources
+            whose shortest path DAG contains edge {i, j}.
+            Removing the edge leaves the contribution of every other source
+            untouched. With hops, that leaves out the sources the edge is
+            out of reach of
+    """
+    di, dj = dist[:, i], dist[:, j]
+    return np.flatnonzero((di != dj) & (di >= 0) & (dj >= 0))
+
+
+def tree_edge_betweenness(graph):
+    """
+        Reference implementation of edge_betweenness that builds a
+        ShortestPathTree per source and back-propagates scores from its
+        leaves. Much slower; kept to check and benchmark edge_betweenness
+        against.
+    """
+    scores = np.zeros(len(graph.indices))
+    for vertex in graph.ids:
+        score_list = defaultdict(int)  # graph slot -> score
+        # Calculate the distance and weights
+        cur_sp_tree = ShortestPathTree(vertex, graph)
+        queue = []
+        visited = defaultdict(bool)
+        for leaf in cur_sp_tree.leaves:
+            visited[leaf.id] = defaultdict(bool)
+            for node in leaf.parents:
+                visited[leaf.id][node.id] = True
+                if node not in queue:
+                    queue.append(node)
+                score = node.weight / leaf.weight
+                score_list[leaf.slots[node.id]] = score
+        while queue:
+            child = queue.pop(0)
+            visited[child.id] = defaultdict(bool)
+            for parent in child.parents:
+                if not visited[child.id][parent.id]:
+                    score = 0
+                    for c in child.children:
+                        edge = score_list[c.slots[child.id]]
+                        score += edge
+                    score += 1
+                    score *= (parent.weight / child.weight)
+                    score_list[child.slots[parent.id]] = score
+                    if parent not in queue:
+                        queue.append(parent)
+                    visited[child.id][parent.id] = True
+        for slot, score in score_list.iteritems():
+            scores[slot] += score
+            scores[graph.twin[slot]] += score
+    return scores
@@ -0,0 +1,104 @@
+import cPickle as pickle
+import json
+import os
+import tempfile
+import time
+
+
+def write_atomically(path, data):
+    """
+        Write data to path so that path holds either its old contents or all
+        of data, never part of it, even if the process dies while writing
+    """
+    directory = os.path.dirname(path) or '.'
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    umask = os.umask(0)
+    os.umask(umask)
+    try:
+        # mkstemp only lets the owner read the file
+        os.fchmod(handle, 0o666 & ~umask)
+        with os.fdopen(handle, 'wb') as temp:
+            temp.write(data)
+            temp.flush()
+            os.fsync(temp.fileno())
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+class Checkpoint(object):
+    """
+        Directory of per-ego network progress, so a crashed or interrupted
+        run can pick up where it stopped.
+
+        Every finished ego network gets a <uid>.json holding its
+        submission.csv line, its circles and its best split level. While a
+        dendrogram is being built, a pickle of it is saved to
+        <uid>.dendrogram after a completed level, at most once every
+        interval seconds, and removed once the ego network is finished.
+
+        Properties:
+        ----------
+        directory: where the checkpoint files are kept
+        interval: minimum number of seconds between two dendrogram snapshots
+            of the same ego network
+    """
+    def __init__(self, directory, interval=60):
+        self.directory = directory
+        self.interval = interval
+        self._last_snapshot = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, uid, extension):
+        return os.path.join(self.directory, "{0}.{1}".format(uid, extension))
+
+    def done(self, uid):
+        return os.path.exists(self._path(uid, 'json'))
+
+    def load_result(self, uid):
+        """
+            Returns
+            -------
+            (uid, line), as returned by analyze in __main__
+        """
+        with open(self._path(uid, 'json')) as handle:
+            result = json.load(handle)
+        return result['uid'], result['line']
+
+    def save_result(self, uid, line, circles, best_split):
+        result = {'uid': uid, 'line': line, 'circles': circles,
+                  'best_split': best_split}
+        write_atomically(self._path(uid, 'json'), json.dumps(result))
+        if os.path.exists(self._path(uid, 'dendrogram')):
+            os.remove(self._path(uid, 'dendrogram'))
+
+    def load_dendrogram(self, uid):
+        """
+            Returns
+            -------
+            the last dendrogram snapshot saved for uid, or None if there is
+            none
+        """
+        if not os.path.exists(self._path(uid, 'dendrogram')):
+            return None
+        with open(self._path(uid, 'dendrogram'), 'rb') as handle:
+            return pickle.load(handle)
+
+    def snapshotter(self, uid):
+        """
+            Returns
+            -------
+            a function to pass to Dendrogram as its checkpoint, which
+            snapshots the dendrogram of uid whenever interval seconds have
+            passed since the last snapshot
+        """
+        self._last_snapshot[uid] = time.time()
+
+        def snapshot(dendrogram):
+            if time.time() - self._last_snapshot[uid] >= self.interval:
+                data = pickle.dumps(dendrogram, pickle.HIGHEST_PROTOCOL)
+                write_atomically(self._path(uid, 'dendrogram'), data)
+                self._last_snapshot[uid] = time.time()
+        return snapshot
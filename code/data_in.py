@@ -1,73 +1,187 @@
-from collections import defaultdict
-from graph import Graph, Vertex
-from uuid import uuid4
-from copy import deepcopy
+from checkpoint import write_atomically
+from graph import Graph, Lineage, Vertex
+from io import BytesIO
+import errno
+import hashlib
 import numpy as np
 import os
 
+# Bump whenever the layout of the cached arrays changes
+CACHE_VERSION = 1
 
-def add_friends(graph, line):
+
+def add_friends(adj_list, line):
     split_line = line.strip('\n').split(' ')
     # Find the ID of the friend in this line
     fid = int(split_line[0][:-1])
     # Generate list of friends of this friend
     ffriends = [int(f) for f in split_line[1:] if f != '']
-    edges = {}
-    for ffid in ffriends:
-        edges[ffid] = 0
     # Store this friend's list of friends in the dict
-    graph.adj_list[fid] = edges
-    return len(graph.adj_list[fid].keys())
+    adj_list[fid] = ffriends
+    return len(adj_list[fid])
 
 
-def map_graph(graph):
+def map_graph(adj_list):
     """
-        Create a uuid for each vertex, separate from the uid (user id).
-        This allows us to split vertices later on.
+        Number the vertices 0 .. n - 1, separate from the uid (user id),
+        with a Lineage to map them back. This allows us to split vertices
+        later on.
+
+        Returns
+        -------
+        the ego network as a Graph over those ids. Friendships listed in
+        only one of the two friends' lines are added in both directions
     """
-    id_map = {}
-    for uid in graph.adj_list.keys():
-        new_id = uuid4()
-        id_map[uid] = new_id
-        graph.vertices[new_id] = Vertex(uid, new_id)
-        graph.adj_list[new_id] = deepcopy(graph.adj_list[uid])
-        del graph.adj_list[uid]
-    for a, edges in graph.adj_list.iteritems():
-        for b in edges.keys():
-            graph.adj_list[a][id_map[b]] = 0
-            del graph.adj_list[a][b]
-
-
-def generate_ego_nets(egonet_path):
+    graph = Graph(0)
+    uids = adj_list.keys()
+    row = dict((uid, v) for v, uid in enumerate(uids))
+    rows = [set() for uid in uids]
+    for a, friends in adj_list.iteritems():
+        for b in friends:
+            rows[row[a]].add(row[b])
+            rows[row[b]].add(row[a])
+    graph.build(Lineage(uids), [sorted(neighbours) for neighbours in rows])
+    graph.size = len(graph.indices) // 2
+    return graph
+
+
+def file_hash(path):
+    with open(path, 'rb') as handle:
+        return hashlib.sha1(handle.read()).hexdigest()
+
+
+def save_cached(cache_path, graph, stamp):
+    """
+        Store the CSR arrays of a freshly read ego network, along with the
+        stamp of the .egonet file they were read from
+    """
+    data = BytesIO()
+    mtime, size, digest = stamp
+    np.savez(data, version=CACHE_VERSION, mtime=mtime, size=size, digest=digest,
+             uids=np.array(graph.lineage.uid, dtype=np.int64), start=graph.start,
+             end=graph.end, indices=graph.indices, twin=graph.twin,
+             owner=graph.owner)
+    write_atomically(cache_path, data.getvalue())
+
+
+def load_cached(cache_path, egonet_file):
+    """
+        Returns
+        -------
+        the ego network stored at cache_path, or None if there's no cached
+        copy or it is out of date with egonet_file. The copy is up to date
+        if the file's mtime and size match, or failing that its hash does
+    """
+    if not os.path.exists(cache_path):
+        return None
+    with np.load(cache_path) as cached:
+        if cached['version'] != CACHE_VERSION:
+            return None
+        stat = os.stat(egonet_file)
+        if (cached['mtime'] != stat.st_mtime or cached['size'] != stat.st_size) and \
+                str(cached['digest']) != file_hash(egonet_file):
+            return None
+        arrays = dict((name, cached[name]) for name in
+                      ('uids', 'start', 'end', 'indices', 'twin', 'owner'))
+    graph = Graph(0)
+    graph.lineage = Lineage(arrays['uids'].tolist())
+    graph.ids = range(len(graph.lineage))
+    graph.vertices = dict((v, Vertex(v)) for v in graph.ids)
+    for name in ('start', 'end', 'indices', 'twin', 'owner'):
+        setattr(graph, name, arrays[name])
+    graph.alive = np.ones(len(graph.indices), dtype=bool)
+    graph.scores = np.zeros(len(graph.indices), dtype=float)
+    graph.size = len(graph.indices) // 2
+    return graph
+
+
+def read_ego_net(egonet_path, file_name, cache_dir=None):
     '''
-        Reads in all ego networks
+        Reads in a single ego network. If cache_dir is given, the parsed
+        network is kept there in binary form, and read back from there as
+        long as the .egonet file hasn't changed
 
         Returns
         -------
-        dictionary of IDs -> ego networks
+        (ID, ego network)
+    '''
+    # Find the ID for the current file
+    pid = int(file_name.split('.')[0])
+    egonet_file = egonet_path + file_name
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, "{0}.npz".format(pid))
+        graph = load_cached(cache_path, egonet_file)
+        if graph:
+            return pid, graph
+        stat = os.stat(egonet_file)
+        stamp = (stat.st_mtime, stat.st_size, file_hash(egonet_file))
+
+    network_handle = open(egonet_file)
+    adj_list = {}
+    for line in network_handle:
+        # Add each of the current user's friends' friendlists
+        add_friends(adj_list, line)
+    network_handle.close()
+    graph = map_graph(adj_list)
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir)
+        except OSError as error:
+            # Another worker may have just made it
+            if error.errno != errno.EEXIST:
+                raise
+        save_cached(cache_path, graph, stamp)
+    return pid, graph
+
+
+def ego_net_files(egonet_path, largest_first=False):
+    '''
+        Lists the ego networks in egonet_path by size, without reading them.
+        The size of a .egonet file grows with the number of friendships in
+        it, so it stands in for the size of the network
+
+        Returns
+        -------
+        list of (ID, file name, file size), smallest first unless
+        largest_first is set
     '''
-    ego_net_lists = {}
-    # Iterate through each file in directory
+    files = []
     for file_name in os.listdir(egonet_path):
-        network_handle = open(egonet_path + file_name)
-        # Find the ID for the current file
         pid = int(file_name.split('.')[0])
+        files.append((pid, file_name, os.path.getsize(egonet_path + file_name)))
+    return sorted(files, key=lambda f: (f[2], f[0]), reverse=largest_first)
 
-        graph = Graph(0)
-        size = 0
-        for line in network_handle:
-            # Add each of the current user's friends' friendlists
-            size += add_friends(graph, line)
-        network_handle.close()
-        map_graph(graph)
-        graph.size = size / 2
-        ego_net_lists[pid] = graph
-    return ego_net_lists
+
+def iter_ego_nets(egonet_path, cache_dir=None, largest_first=False):
+    '''
+        Reads in the ego networks one at a time, smallest first unless
+        largest_first is set, through the binary cache in cache_dir if given.
+        Each network is only read when the caller asks for it, and nothing
+        is kept once it has been handed over
+
+        Returns
+        -------
+        generator of (ID, ego network)
+    '''
+    for pid, file_name, file_size in ego_net_files(egonet_path, largest_first):
+        yield read_ego_net(egonet_path, file_name, cache_dir)
+
+
+def generate_ego_nets(egonet_path, cache_dir=None):
+    '''
+        Reads in all ego networks, through the binary cache in cache_dir if
+        given
+
+        Returns
+        -------
+        dictionary of IDs -> ego networks
+    '''
+    return dict(iter_ego_nets(egonet_path, cache_dir))
 
 
-def read_data(egonet_path):
+def read_data(egonet_path, cache_dir=None):
     # First command line argument is path to egonet directory
-    ego_net_lists = generate_ego_nets(egonet_path)
+    ego_net_lists = generate_ego_nets(egonet_path, cache_dir)
     print "Generated ego networks"
 
     return ego_net_lists
@@ -4,9 +4,13 @@ from data_in import read_data
 from sys import argv
 from operator import itemgetter
 from graph import Vertex
-from shortest_path_tree import ShortestPathTree
-from itertools import combinations
+from modularity import ModularityTracker
+from betweenness import affected_sources, edge_betweenness, sampled_edge_betweenness
+from parallel import SourcePool
+from profiling import Profiler
 from copy import copy
+import heapq
+import numpy as np
 
 
 class Node(object):
@@ -21,32 +25,66 @@ class Node(object):
         parent: reference to parent node
         left, right: reference to children nodes. If None, then self
             is a leaf. If only self.right is None, graph is a singleton node
-        edge_comparisons: dictionary that maps from a node id to many edges
-            were removed to split this node and that one
+        removed_edges: how many edges were removed from the clone. Once
+            the node is split, that is the number of edges between its
+            children
         level: the level of this node in the dendrogram
+        used: the last dendrogram level at which the distance matrix of the
+            clone was computed or read, to pick which ones to evict first
 
         Methods:
         -------
-        calculate_e_betweenness(): recalculate edge betweenness. Uses the clone,
-            NOT the graph. Call after removing an edge
-        calculate_v_betweenness(): recalculate vertex betweenness using edge
-            betweenness. Call after calculating edge betweenness
+        calculate_e_betweenness(): recalculate edge and vertex betweenness.
+            Uses the clone, NOT the graph. Call after splitting a vertex
+        set_max_scores(): find the highest edge and vertex betweenness of
+            the clone
+        distances(): the distance matrix of the clone, recomputed if it was
+            evicted
+        remove_edge(i, j): remove an edge from the clone and update edge
+            and vertex betweenness to match
     """
+    __slots__ = ('tree', 'id', 'graph', 'clone', 'parent', 'level', 'used',
+                 'removed_edges', '_left', '_right')
+
     def __init__(self, tree, graph, parent):
         self.tree = tree
         self.id = self.tree.node_cnt
         self.graph = graph
         self.clone = self.graph.clone()
+        # Only the distance matrix of the clone is kept, so that
+        # release_dags frees the one copy of it
+        self.graph.dist = None
         self.parent = parent
         self.level = parent.level + 1 if parent else 0
+        self.used = parent.used if parent else 0
         self.tree.levels[self.level].append(self)
         self.removed_edges = 0
-        self.edge_comparisons = defaultdict(int)
         self._left = None
         self._right = None
-        self.calculate_e_betweenness()
+        # A node carried down unchanged from the level above keeps the
+        # scores, and the highest edge and vertex scores, found for it there
+        if not self.clone.scored:
+            self.calculate_e_betweenness()
+        elif self.clone.size > 0 and self.clone.v_scores is None:
+            self.set_max_scores()
         self.tree.node_cnt += 1
 
+    def __getstate__(self):
+        state = dict((name, getattr(self, name)) for name in self.__slots__)
+        for link in ('parent', '_left', '_right'):
+            state[link] = state[link].id if state[link] else None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+    def relink(self, nodes):
+        """Swap the node ids left by unpickling back for the nodes"""
+        for link in ('parent', '_left', '_right'):
+            if getattr(self, link) is not None:
+                setattr(self, link, nodes[getattr(self, link)])
+
     @property
     def left(self):
         return self._left
@@ -63,64 +101,131 @@ class Node(object):
     def right(self, graph):
         self._right = Node(self.tree, graph, self)
 
-    def set_edge_comparisons(self):
-        for node in self.tree.levels[self.level - 1]:
-            if node != self.parent:
-                self.edge_comparisons[node.left.id] = self.parent.edge_comparisons[node.id]
-                if node.right:
-                    self.edge_comparisons[node.right.id] = self.parent.edge_comparisons[node.id]
-
     def calculate_e_betweenness(self):
         if self.clone.size > 0:
-            self.clone.sp_trees = []
-            self.clone.reset_betweenness()
-            for vertex in self.clone.adj_list.keys():
-                score_list = defaultdict(lambda: defaultdict(int))
-                # Calculate the distance and weights
-                cur_sp_tree = ShortestPathTree(vertex, self.clone.adj_list)
-                self.clone.sp_trees.append(cur_sp_tree)
-                queue = []
-                visited = defaultdict(bool)
-                for leaf in cur_sp_tree.leaves:
-                    visited[leaf.uuid] = defaultdict(bool)
-                    for node in leaf.parents:
-                        visited[leaf.uuid][node.uuid] = True
-                        if node not in queue:
-                            queue.append(node)
-                        score = node.weight / leaf.weight
-                        score_list[leaf.uuid][node.uuid] = score
-                        score_list[node.uuid][leaf.uuid] = score
-                while queue:
-                    child = queue.pop(0)
-                    visited[child.uuid] = defaultdict(bool)
-                    for parent in child.parents:
-                        if not visited[child.uuid][parent.uuid]:
-                            score = 0
-                            for c in child.children:
-                                edge = score_list[c.uuid][child.uuid]
-                                score += edge
-                            score += 1
-                            score *= (parent.weight / child.weight)
-                            score_list[child.uuid][parent.uuid] = score
-                            score_list[parent.uuid][child.uuid] = score
-                            if parent not in queue:
-                                queue.append(parent)
-                            visited[child.uuid][parent.uuid] = True
-                for a, edge_list in score_list.iteritems():
-                    for b, score in edge_list.iteritems():
-                        self.clone.adj_list[a][b] += score
-            self.clone.set_max_edge()
-
-    def calculate_v_betweenness(self):
-        n = len(self.clone.adj_list.keys())  # number of vertices in the graph
-        best_edge_score = self.tree.best_edge(self.level)[3]
-        for uuid, edges in self.clone.adj_list.iteritems():
-            score = sum([b - (n - 1) for b in edges.values()]) / 2
-            vertex = self.clone.vertices[uuid]
-            vertex.v_betweenness = score
-            vertex.reset()
-            if score > best_edge_score:
-                self.clone.viable_vertices.append(vertex)
+            self.clone.scores, self.clone.dist, self.clone.sources = \
+                self.tree.sampled_edge_betweenness(self.clone)
+            self.clone.scored = True
+            self.used = self.tree.level
+            self.set_max_scores()
+
+    def set_max_scores(self):
+        self.clone.set_max_edge()
+        if self.tree.hops is None:
+            self.clone.set_max_vertex()
+        else:
+            dist = self.distances()
+            reach = (dist > 0).sum(axis=0) * len(self.clone.ids) / len(dist)
+            self.clone.set_max_vertex(reach=reach)
+
+    def distances(self):
+        if self.clone.dist is None and self.clone.scored:
+            # Evicted while the scores still stand: search again from the
+            # same sources, so a sample isn't drawn afresh
+            self.clone.dist = self.tree.edge_betweenness(self.clone, self.clone.sources)[1]
+        elif self.clone.dist is None:
+            self.calculate_e_betweenness()
+        self.used = self.tree.level
+        return self.clone.dist
+
+    def remove_edge(self, i, j):
+        """
+            Remove edge {i, j} from the clone and bring the betweenness
+            scores up to date. In incremental mode, only the sources whose
+            shortest path DAG contained the edge are searched again: their
+            old contribution is subtracted before the removal and their new
+            one added after it. This gives exactly the scores of a full
+            recompute, and is used whenever it needs fewer searches than one
+
+            Returns:
+            -------
+            the ids of the vertices whose pair betweennesses may have
+                changed: those that some source's distance to changed, and
+                their neighbours. None if that could be any of them
+        """
+        dist = self.clone.dist
+        positions = None
+        if dist is not None and self.clone.sources is None:
+            positions = affected_sources(dist, i, j)
+        if (self.tree.incremental and positions is not None and
+                2 * len(positions) < len(self.clone.ids)):
+            self.clone.detach()
+            dist = self.clone.dist
+            sources = np.asarray(self.clone.ids)[positions]
+            old_scores, old_dist = self.tree.edge_betweenness(self.clone, sources)
+            self.clone.remove_edge(i, j, self)
+            new_scores, new_dist = self.tree.edge_betweenness(self.clone, sources)
+            changed = (new_dist != old_dist).any(axis=0)
+            changed[[i, j]] = True
+            dist[positions] = new_dist
+            self.clone.scores += new_scores - old_scores
+            self.clone.scored = True
+            self.clone.dist = dist
+            self.used = self.tree.level
+            if self.clone.size > 0:
+                self.set_max_scores()
+            return self.clone.neighbourhood(changed)
+        else:
+            self.clone.remove_edge(i, j, self)
+            self.calculate_e_betweenness()
+
+
+class LevelIndex(object):
+    """
+        Priority queues over the nodes of one dendrogram level, keyed by the
+        highest edge betweenness and the highest vertex betweenness found in
+        each node's clone. When a node changes, update() pushes fresh
+        entries for it, and the old ones are dropped as they come up (lazy
+        deletion), so finding the next cut doesn't scan the whole level.
+
+        Ties go to the node that comes first in the level.
+
+        Methods:
+        -------
+        best_edge(): (node, i, j, betweenness) for the edge {i, j} with the
+            highest betweenness on the level
+        splittable_vertices(threshold): list of (node, vertex) for every
+            vertex on the level with vertex betweenness above threshold
+        update(node): re-key node after its clone has changed
+    """
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        self.position = dict((node.id, k) for k, node in enumerate(self.nodes))
+        self.version = [0] * len(self.nodes)
+        self.edges = []
+        self.vertices = []
+        for k, node in enumerate(self.nodes):
+            self._push(k, node)
+        heapq.heapify(self.edges)
+        heapq.heapify(self.vertices)
+
+    def _push(self, k, node, push=list.append):
+        if node.clone.size > 0:
+            push(self.edges, (-node.clone.max_e_betweenness[2], k, self.version[k]))
+            push(self.vertices, (-node.clone.max_v_betweenness[1], k, self.version[k]))
+
+    def _top(self, heap):
+        while heap and heap[0][2] != self.version[heap[0][1]]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def update(self, node):
+        k = self.position[node.id]
+        self.version[k] += 1
+        self._push(k, node, heapq.heappush)
+
+    def best_edge(self):
+        score, k, version = self._top(self.edges)
+        return (self.nodes[k],) + self.nodes[k].clone.max_e_betweenness
+
+    def splittable_vertices(self, threshold):
+        above = []
+        while self._top(self.vertices) and -self.vertices[0][0] > threshold:
+            above.append(heapq.heappop(self.vertices))
+        for entry in above:
+            heapq.heappush(self.vertices, entry)
+        return [(self.nodes[k], vertex) for score, k, version in sorted(above, key=itemgetter(1))
+                for vertex in self.nodes[k].clone.viable_vertices(threshold)]
 
 
 class Dendrogram(object):
@@ -137,104 +242,262 @@ class Dendrogram(object):
         -------
         convert_to_circles(): return a dict, maps ints (0 - num_levels) to a
             list of circles, where each circle is a list of graph vertices
+
+        With incremental set (the default), edge removals only redo the
+        betweenness searches they affect. Set it to False to always
+        recompute from every source. With workers above 1, the sources of
+        each betweenness pass are split over that many processes.
+
+        Given hops, betweenness only counts the shortest paths of at most
+        that many edges, which approximates the exact scores with local
+        ones, see betweenness.edge_betweenness. The searches from vertices
+        more than hops away from a removed edge are then left alone, so
+        each removal only redoes the edge's neighbourhood.
+
+        Given sample, an (epsilon, delta) pair, each node's betweenness is
+        estimated from a random sample of its vertices as sources instead,
+        drawn from a RandomState seeded with seed, see
+        betweenness.sampled_edge_betweenness. Edge removals then rescore
+        the node from a fresh sample rather than incrementally.
+
+        If given, checkpoint is called with the dendrogram after every
+        completed level. A dendrogram can be pickled at that point and
+        carried on later with resume().
+
+        The distance matrices kept with each node's scores are freed once
+        the node's level is done. If dag_budget is given, the ones on the
+        current level are also evicted, least recently used first, until
+        they take up at most that many bytes, and recomputed if needed.
+
+        The modularity of each level is tracked as it is built, in
+        modularity. Given stop_drop, the build stops early once a level's
+        modularity is that much below the best so far, and given
+        max_levels, once there are that many levels. The deep levels left
+        out are rarely the best split, and take up most of the time.
+
+        profiler, a profiling.Profiler, counts and times every edge
+        removal, vertex split, betweenness pass, connectivity search and
+        pair and split betweenness evaluation, and hears about each
+        finished level.
     """
-    def __init__(self, network):
+    def __init__(self, network, incremental=True, workers=1, checkpoint=None,
+                 dag_budget=None, stop_drop=None, max_levels=None, profiler=None,
+                 hops=None, sample=None, seed=None):
 
         print "\tCreating dendrogram..."
 
+        self.incremental = incremental
+        self.hops = hops
+        self.sample = sample
+        self.random = np.random.RandomState(seed)
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.dag_budget = dag_budget
+        self.stop_drop = stop_drop
+        self.max_levels = max_levels
+        self.profiler = profiler or Profiler()
+        self.pool = SourcePool(workers, network) if workers > 1 else None
         self.levels = defaultdict(list)
+        self.modularity = ModularityTracker(network.size)
         self.node_cnt = 0
+        self.level = 0
         self.root = Node(self, network, None)
         self.initial_split(network)
+        self.release_dags(0)
+        self.modularity.add_level(self.levels[0])
+        self.modularity.add_level(self.levels[1])
 
-        level = 1
-        removed_edges = 0
+        self.level = 1
+        self.removed_edges = 0
+        self.profiler.end_level(0, network.size)
+        self.build()
 
-        while removed_edges < network.size:
+    def build(self):
+        """
+            Split the graph one level at a time, starting from self.level,
+            until every edge has been removed or stopped() says to stop early
+        """
+        while self.removed_edges < self.root.graph.size and not self.stopped():
+            level = self.level
+            index = LevelIndex(self.levels[level])
             is_connected = True
             while is_connected:
-                splittable_vertices = self.splittable_vertices(level)
-                best_vertex = (None, None, None, None, 0)
-                best_node, i, j, e_score = self.best_edge(level)
-                for v in splittable_vertices:  # calculate split betweennesses
-                    node = v[0]
-                    vertex = v[1]
-                    node.clone.set_pair_betweenness(vertex)
-                    if vertex.pair_betweennesses.keys():
-                        vertex.set_split_betweenness()
-                        if vertex.split_betweenness[2] > best_vertex[4]:
-                            best_vertex = (node, vertex) + vertex.split_betweenness
+                best_node, i, j, e_score = index.best_edge()
+                best_vertex = self.best_split(index, e_score)
                 if best_vertex[4] > e_score:  # should split vertex instead of remove edge
                     best_node, vertex, side_one, side_two, v_score = best_vertex
-                    j = best_node.clone.split_vertex(vertex, side_one, side_two)
-                    i = vertex.uuid
+                    with self.profiler.span('vertex_split', vertex=vertex.id):
+                        j = best_node.clone.split_vertex(vertex, side_one, side_two)
+                        i = vertex.id
+                        best_node.calculate_e_betweenness()
+                    stale = None
                 else:  # remove edge as usual
-                    best_node.clone.remove_edge(i, j, best_node)
-                    removed_edges += 1
-                best_node.calculate_e_betweenness()
-                is_connected, children = best_node.clone.connected_components(i, j)
+                    with self.profiler.span('edge_removal', edge=[i, j]):
+                        stale = best_node.remove_edge(i, j)
+                    self.removed_edges += 1
+                best_node.clone.reset_vertices(stale)
+                index.update(best_node)
+                with self.profiler.span('bfs'):
+                    is_connected, children = best_node.clone.connected_components(i, j)
             best_node.left, best_node.right = children
-            best_node.left.edge_comparisons[best_node.right.id] = best_node.removed_edges
-            best_node.right.edge_comparisons[best_node.left.id] = best_node.removed_edges
             for node in self.levels[level]:
                 if node != best_node:
                     node.left = node.clone  # propogate everything to the next level
-                node.set_edge_comparisons()
-            level += 1
+            self.release_dags(level)
+            self.level += 1
+            self.modularity.add_level(self.levels[self.level])
+            self.profiler.end_level(self.removed_edges, self.root.graph.size)
+            if self.checkpoint:
+                self.checkpoint(self)
+        if self.pool:
+            self.pool.close()
 
-    def initial_split(self, network):
-        """
-            Put each connected component of the initial graph into its own node
+    def best_split(self, index, e_score):
         """
-        is_connected = True
-        pairs = list(combinations(network.adj_list.keys(), 2))
-        while is_connected and pairs:
-            i, j = pairs.pop()
-            is_connected, children = network.connected_components(i, j)
-            if not is_connected:
-                left, right = children
-                Node(self, left, self.root)
-                self.initial_split(right)
-                return
-        Node(self, network, self.root)
-
-    def best_edge(self, level):
-        """
-            Parameters:
-            ----------
-            level: level of dendrogram to find best edge for
+            Find the vertex on the level with the highest split
+            betweenness, if any beats e_score, by branch and bound. A split
+            only keeps the pair betweennesses running across its two sides,
+            so their total over all pairs bounds its score. That total is
+            cheap to find from the distances alone, so the pair
+            betweennesses and the greedy split are only worked out for the
+            candidates whose bound can still win, tried from the highest
+            bound down. Ties go to the vertex that comes first in
+            splittable_vertices order, as if every one had been tried.
+
+            Bounds, pair and split betweennesses are kept on the vertices
+            until their node's clone changes around them, see
+            Graph.reset_vertices.
 
             Returns:
             -------
-            (node, i, j, betweenness) where node is the node containing edge {i, j}
-                and {i, j} is the edge with highest betweenness in nodes
+            (node, vertex, side_one, side_two, split betweenness), or a
+                split betweenness of 0 if there is nothing to split
+        """
+        candidates = []
+        for order, (node, vertex) in enumerate(index.splittable_vertices(e_score)):
+            if vertex.split_bound is None:
+                node.distances()
+                with self.profiler.span('split_bound', vertex=vertex.id):
+                    node.clone.set_split_bound(vertex)
+            if vertex.split_bound > e_score:
+                candidates.append((-vertex.split_bound, order, node, vertex))
+        candidates.sort(key=itemgetter(0, 1))
+        best_vertex, best_order = (None, None, None, None, 0), len(candidates)
+        for bound, order, node, vertex in candidates:
+            if -bound < best_vertex[4]:
+                break
+            if vertex.pair_ids is None:
+                node.distances()
+                with self.profiler.span('pair_betweenness', vertex=vertex.id):
+                    node.clone.set_pair_betweenness(vertex)
+            if vertex.split_betweenness is None:
+                with self.profiler.span('split_betweenness', vertex=vertex.id):
+                    vertex.set_split_betweenness()
+            score = vertex.split_betweenness[2]
+            if score > best_vertex[4] or (score == best_vertex[4] and order < best_order):
+                best_vertex, best_order = (node, vertex) + vertex.split_betweenness, order
+        return best_vertex
+
+    def stopped(self):
+        """Whether stop_drop or max_levels call for an early stop"""
+        if self.max_levels is not None and len(self.modularity.qs) >= self.max_levels:
+            return True
+        return self.stop_drop is not None and self.modularity.dropped(self.stop_drop)
+
+    def resume(self, workers=1, checkpoint=None, dag_budget=None, stop_drop=None,
+               max_levels=None, profiler=None):
+        """
+            Carry on building an unpickled dendrogram from the level it was
+            saved at. It keeps the hops, sample and random state it was
+            saved with, so that it carries on as it would have
+        """
+        print "\tResuming dendrogram at level {0}...".format(self.level)
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.dag_budget = dag_budget
+        self.stop_drop = stop_drop
+        self.max_levels = max_levels
+        self.profiler = profiler or Profiler()
+        self.profiler.level = self.level
+        self.pool = SourcePool(workers, self.root.graph) if workers > 1 else None
+        self.build()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['pool'], state['checkpoint'], state['modularity'], state['profiler']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pool = None
+        self.checkpoint = None
+        self.profiler = Profiler()
+        # Nodes are pickled without their links to each other, which would
+        # nest one level deeper per dendrogram level
+        nodes = dict((node.id, node) for level in self.levels.values() for node in level)
+        for node in nodes.itervalues():
+            node.relink(nodes)
+        self.modularity = ModularityTracker(self.root.graph.size)
+        for level in sorted(self.levels):
+            self.modularity.add_level(self.levels[level])
+
+    def release_dags(self, level):
+        """
+            Free the distance matrices of the nodes on level, which is done,
+            then evict ones from the next level while they're over budget
         """
-        bests = []
         for node in self.levels[level]:
-            if node.clone.size > 0:
-                bests.append((node,) + node.clone.max_e_betweenness)
-        return max(bests, key=itemgetter(2))
+            node.clone.dist = None
+        if self.dag_budget is None:
+            return
+        held = [node for node in self.levels[level + 1] if node.clone.dist is not None]
+        total = sum(node.clone.dist.nbytes for node in held)
+        for node in sorted(held, key=lambda node: (node.used, -node.clone.dist.nbytes)):
+            if total <= self.dag_budget:
+                break
+            total -= node.clone.dist.nbytes
+            node.clone.dist = None
 
-    def splittable_vertices(self, level):
+    def edge_betweenness(self, graph, sources=None):
+        """betweenness.edge_betweenness, run on the pool if there is one"""
+        name = 'betweenness' if sources is None else 'partial_betweenness'
+        with self.profiler.span(name, sources=len(graph.ids if sources is None else sources)):
+            if self.pool:
+                return self.pool.edge_betweenness(graph, sources, self.hops)
+            return edge_betweenness(graph, sources, self.hops)
+
+    def sampled_edge_betweenness(self, graph):
         """
-            Parameters:
-            ----------
-            level: level of dendrogram to find splittable vertices for
+            betweenness.sampled_edge_betweenness run through edge_betweenness,
+            or the exact scores if not sampling
 
             Returns:
             -------
-            (node, vertex) where node is the node containing vertex v
-                and v has vertex betweenness greater than the max edge
-                betweenness
+            (scores, dist, sources), as sampled_edge_betweenness
         """
-        bests = []
-        for node in self.levels[level]:
-            node.calculate_v_betweenness()
-            if node.clone.viable_vertices:
-                for v in node.clone.viable_vertices:
-                    bests.append((node, v))
-                node.clone.viable_vertices = []
-        return bests
+        if self.sample is None:
+            scores, dist = self.edge_betweenness(graph)
+            return scores, dist, None
+        epsilon, delta = self.sample
+        return sampled_edge_betweenness(graph, epsilon, delta, self.random,
+                                        self.edge_betweenness)
+
+    def initial_split(self, network):
+        """
+            Put each connected component of the initial graph into its own
+            node. The components are cut from the root's clone, so they
+            keep its betweenness scores instead of being scored again.
+
+            Ties on later levels go to the node that comes first, so the
+            components are added in the fixed order of Graph.components
+        """
+        with self.profiler.span('bfs'):
+            components = self.root.clone.components()
+        if len(components) < 2:
+            Node(self, self.root.clone, self.root)
+            return
+        for component in components:
+            Node(self, component, self.root)
 
     def convert_to_circles(self):
         """
@@ -245,7 +508,7 @@ class Dendrogram(object):
         """
         out = {}
         for k, v in self.levels.iteritems():
-            out[k] = [[n.graph.vertices[uid].uid for uid in n.graph.adj_list.keys()] for n in v]
+            out[k] = [[n.graph.lineage.uid[vid] for vid in n.graph.ids] for n in v]
         return out
 
     def __str__(self):
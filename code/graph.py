@@ -1,120 +1,438 @@
-from collections import defaultdict, Iterable
-from copy import deepcopy
-from operator import itemgetter
-from uuid import uuid4
+from collections import Iterable
+from copy import copy
 import itertools
+import numpy as np
+import traversal
 
 
-def flatten(tup):
-    for el in tup:
-        if isinstance(el, Iterable):
-            for sub in flatten(el):
-                yield sub
-        else:
-            yield el
+class Lineage(object):
+    """
+        Table of the vertex ids handed out for one ego network, shared by
+        every Graph cut from it. Ids are dense integers allocated from a
+        counter, so they double as row indices into the adjacency arrays.
+
+        Properties:
+        ----------
+        uid: list mapping each vertex id to the user id it stands for
+        parent: list mapping each vertex id to the id it was split off
+            from, -1 for the original vertices
+    """
+    def __init__(self, uids):
+        self.uid = list(uids)
+        self.parent = [-1] * len(self.uid)
+
+    def __len__(self):
+        return len(self.uid)
+
+    def split(self, vid):
+        """
+            Returns:
+            -------
+            a new vertex id for a copy split off from vid
+        """
+        self.uid.append(self.uid[vid])
+        self.parent.append(vid)
+        return len(self.uid) - 1
 
 
 class Vertex(object):
-    """Vertex of a Graph"""
-    def __init__(self, uid, uuid):
-        self.uuid = uuid
-        self.uid = uid
+    """
+        Vertex of a Graph
+
+        pair_betweennesses is only filled in, by
+        Graph.set_pair_betweenness, for the vertices that are candidates
+        for a split, and is None otherwise. It is a symmetric matrix over
+        the neighbours in pair_ids: entry [a, b] counts the shortest paths
+        that run from pair_ids[a] through this vertex to pair_ids[b].
+        split_bound, set by Graph.set_split_bound, is the total of those
+        counts over all pairs, which no split of the vertex can beat
+    """
+    __slots__ = ('id', 'v_betweenness', 'pair_ids', 'pair_betweennesses',
+                 'split_betweenness', 'split_bound')
+
+    def __init__(self, vid):
+        self.id = vid
         self.v_betweenness = None
-        self.pair_betweennesses = defaultdict(lambda: defaultdict(int))
+        self.pair_ids = None
+        self.pair_betweennesses = None
         self.split_betweenness = None
-
-    def find_min_pair(self):
-        best = (None, None, float('inf'))
-        for a, edges in self.pair_betweennesses.iteritems():
-            for b, score in edges.iteritems():
-                if score < best[2]:
-                    best = (a, b, score)
-        return best[0], best[1]
-
-    def coalesce(self):
-        i, j = self.find_min_pair()
-        coalesce = tuple(flatten((i, j)))
-        for k in self.pair_betweennesses.keys():
-            if k != i and k != j:
-                i_score = self.pair_betweennesses[i][k]
-                j_score = self.pair_betweennesses[j][k]
-                self.pair_betweennesses[coalesce][k] = i_score + j_score
-                self.pair_betweennesses[k][coalesce] = i_score + j_score
-                del self.pair_betweennesses[k][i]
-                del self.pair_betweennesses[k][j]
-        del self.pair_betweennesses[i]
-        del self.pair_betweennesses[j]
+        self.split_bound = None
 
     def set_split_betweenness(self):
-        while len(self.pair_betweennesses.keys()) > 2:
-            self.coalesce()
-        uids = self.pair_betweennesses.keys()
-        score = self.pair_betweennesses[uids[0]][uids[1]]
-        self.split_betweenness = (uids[0], uids[1], score)
+        """
+            Greedily merge the neighbours into two sides, each time joining
+            the two groups with the fewest shortest paths running between
+            them, and set split_betweenness to (side_one, side_two, score),
+            where score is the number of paths still running between the
+            two sides. Ties go to the pair of groups that comes first in
+            pair_ids order.
+
+            The lowest score in each row of the matrix is kept, so a merge
+            only rescans the rows whose lowest score it may have changed
+        """
+        scores = self.pair_betweennesses.astype(float)
+        k = len(scores)
+        np.fill_diagonal(scores, np.inf)
+        groups = [[v] for v in self.pair_ids.tolist()]
+        live = np.ones(k, dtype=bool)
+        best = scores.argmin(axis=1)
+        lowest = scores[np.arange(k), best]
+        for merge in xrange(k - 2):
+            # The first row holding the lowest score finds it past the
+            # diagonal, so a < b
+            a = lowest.argmin()
+            b = best[a]
+            scores[a] += scores[b]
+            scores[:, a] = scores[a]
+            scores[a, a] = np.inf
+            scores[b] = np.inf
+            scores[:, b] = np.inf
+            groups[a].extend(groups[b])
+            groups[b] = None
+            live[b] = False
+            lowest[b] = np.inf
+            stale = live & ((best == a) | (best == b) | (scores[:, a] <= lowest))
+            stale[a] = True
+            rows = np.flatnonzero(stale)
+            best[rows] = scores[rows].argmin(axis=1)
+            lowest[rows] = scores[rows, best[rows]]
+        a, b = np.flatnonzero(live)
+        self.split_betweenness = (tuple(groups[a]), tuple(groups[b]), scores[a, b])
 
     def reset(self):
-        self.pair_betweennesses = defaultdict(lambda: defaultdict(int))
+        self.pair_ids = None
+        self.pair_betweennesses = None
         self.split_betweenness = None
+        self.split_bound = None
 
 
 class Graph(object):
-    """Wrapper class for a graph"""
+    """
+        Wrapper class for a graph
+
+        The adjacency is stored in compressed sparse row (CSR) form, with a
+        row for every vertex id of lineage. The neighbours of vertex v are
+        indices[start[v]:end[v]], and scores holds the edge betweenness of
+        each of those slots. Every undirected edge takes up two slots, one in
+        each endpoint's row: twin maps a slot to the opposite one, and owner
+        maps a slot back to its vertex. ids lists the vertices that belong
+        to this graph; the rows of all other vertices are empty.
+
+        Removing an edge tombstones its two slots in alive instead of
+        compacting the row. Splitting a vertex moves the slots it gives away
+        to the tail of its row and hands that tail to the new vertex, so the
+        slot arrays are never reallocated after the graph is built.
+
+        scored is True while scores are up to date. dist is the distance
+        matrix of the betweenness pass that produced them, with a row for
+        each vertex of ids and a column for every vertex id. Together with
+        the adjacency it holds each source's whole shortest path DAG: the
+        predecessors of v are its neighbours one step closer to the source.
+        It is None whenever scores are out of date, and may also be dropped
+        to save memory while they are not. If the scores were estimated from
+        a sample of the sources, sources lists them, in the order of the
+        rows of dist; it is None when every vertex of ids was a source.
+
+        clone() is copy-on-write: the copy shares the arrays, ids and
+        vertices of the original, and whichever of the two is modified
+        first through remove_edge or split_vertex takes its own copies.
+        Anything else that writes into the arrays must call detach() first.
+        The scratch data on vertices (betweenness and split scores) is not
+        structural, and is written without detaching.
+    """
     def __init__(self, size):
         self.size = size
-        self.adj_list = {}
+        self.lineage = None
         self.vertices = {}
-        self.viable_vertices = []
-        self.sp_trees = []
+        self.ids = []
+        self.start = np.zeros(0, dtype=np.intp)
+        self.end = np.zeros(0, dtype=np.intp)
+        self.indices = np.zeros(0, dtype=np.intp)
+        self.twin = np.zeros(0, dtype=np.intp)
+        self.owner = np.zeros(0, dtype=np.intp)
+        self.alive = np.zeros(0, dtype=bool)
+        self.scores = np.zeros(0, dtype=float)
+        self.scored = False
+        self.dist = None
+        self.sources = None
+        self.v_scores = None
         self.max_e_betweenness = None
         self.max_v_betweenness = None
+        self._adjacency = None
+        self._shared = False
+
+    def build(self, lineage, rows):
+        """
+            Fill in the CSR arrays from a list of neighbour rows.
+
+            Parameters:
+            ----------
+            lineage: Lineage of the vertices, which must all be original
+            rows: list of lists, rows[v] holds the ids of the neighbours of
+                vertex v. Must be symmetric
+        """
+        n = len(rows)
+        degrees = np.array([len(row) for row in rows], dtype=np.intp)
+        self.lineage = lineage
+        self.ids = range(n)
+        self.vertices = dict((v, Vertex(v)) for v in self.ids)
+        self.end = np.cumsum(degrees)
+        self.start = self.end - degrees
+        self.indices = np.fromiter(itertools.chain.from_iterable(rows),
+                                   dtype=np.intp, count=int(degrees.sum()))
+        self.owner = np.repeat(np.arange(n, dtype=np.intp), degrees)
+        keys = self.owner * n + self.indices
+        order = np.argsort(keys)
+        self.twin = order[np.searchsorted(keys, self.indices * n + self.owner,
+                                          sorter=order)]
+        self.alive = np.ones(len(self.indices), dtype=bool)
+        self.scores = np.zeros(len(self.indices), dtype=float)
+        self._changed()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_adjacency'] = None
+        return state
+
+    def _changed(self):
+        """Drop everything derived from the adjacency"""
+        self._adjacency = None
+        self.scored = False
+        self.dist = None
+        self.sources = None
+        self.v_scores = None
+
+    def adjacency(self):
+        """
+            Returns:
+            -------
+            list indexed by vertex id of lists of (slot, neighbour id) pairs
+                for the live edges of that vertex. Cached until the graph
+                changes
+        """
+        if self._adjacency is None:
+            indices = self.indices.tolist()
+            alive = self.alive.tolist()
+            self._adjacency = [[(k, indices[k]) for k in xrange(s, e) if alive[k]]
+                               for s, e in itertools.izip(self.start.tolist(),
+                                                          self.end.tolist())]
+        return self._adjacency
+
+    def neighbors(self, vid):
+        return [w for k, w in self.adjacency()[vid]]
+
+    def incident_scores(self):
+        """
+            Returns:
+            -------
+            (degrees, totals): arrays indexed by vertex id holding the number
+                of live edges of each vertex and the sum of their scores
+        """
+        n = len(self.start)
+        owners = self.owner[self.alive]
+        degrees = np.bincount(owners, minlength=n)
+        totals = np.bincount(owners, weights=self.scores[self.alive], minlength=n)
+        return degrees, totals
 
     def reset_betweenness(self):
-        for a, edge_list in self.adj_list.iteritems():
-            for b, score in edge_list.iteritems():
-                self.adj_list[a][b] = 0
+        self.detach()
+        self.scores.fill(0)
 
     def set_max_edge(self):
+        """
+            Sets max_e_betweenness to (i, j, betweenness) for the live edge
+            with the highest betweenness score
+        """
+        live = np.flatnonzero(self.alive)
+        k = live[np.argmax(self.scores[live])]
+        self.max_e_betweenness = (int(self.owner[k]), int(self.indices[k]),
+                                  float(self.scores[k]))
+
+    def set_max_vertex(self, reach=None):
+        """
+            Sets v_scores to the vertex betweenness of each vertex of ids,
+            worked out from the edge scores, and max_v_betweenness to
+            (vertex, betweenness) for the highest of them.
+
+            reach, indexed by vertex id, gives the number of other vertices
+            each vertex has shortest paths to when the scores only count
+            the ones of a limited length. Otherwise that is all of them
+        """
+        n = len(self.ids)  # number of vertices in the graph
+        degrees, totals = self.incident_scores()
+        ids = np.array(self.ids, dtype=np.intp)
+        ends = n - 1 if reach is None else reach[ids]
+        self.v_scores = (totals[ids] - degrees[ids] * ends) / 2
+        k = np.argmax(self.v_scores)
+        self.max_v_betweenness = (self.ids[k], float(self.v_scores[k]))
+
+    def viable_vertices(self, threshold):
+        """
+            Returns:
+            -------
+            the vertices with vertex betweenness above threshold, which may
+                be worth splitting, in ids order
+        """
+        viable = []
+        for k in np.flatnonzero(self.v_scores > threshold):
+            vertex = self.vertices[self.ids[k]]
+            vertex.v_betweenness = self.v_scores[k]
+            viable.append(vertex)
+        return viable
+
+    def reset_vertices(self, stale=None):
+        """
+            Forget the pair and split betweennesses worked out for the old
+            scores, only for the vertex ids in stale if given
+        """
+        vertices = self.vertices.itervalues() if stale is None else \
+            (self.vertices[v] for v in stale)
+        for vertex in vertices:
+            vertex.reset()
+
+    def neighbourhood(self, members):
         """
             Parameters:
             ----------
-            score_list: adjacency list style dictionary that maps to betweenness
-            scores
+            members: boolean array over vertex ids
 
             Returns:
             -------
-            (i, j, betweenness)
+            the ids of the vertices of the graph that are in members or next
+                to one of them
         """
-        ig1 = itemgetter(1)
-        ig2 = lambda t: t[1][1]
-        max_edge = max([(uid, max(edges.iteritems(), key=ig1)) for uid, edges in self.adj_list.iteritems() if edges], key=ig2)
-        self.max_e_betweenness = max_edge[0], max_edge[1][0], max_edge[1][1]
+        around = members.copy()
+        around[self.owner[self.alive & members[self.indices]]] = True
+        ids = np.array(self.ids, dtype=np.intp)
+        return ids[around[ids]].tolist()
 
     def clone(self):
         graph = Graph(self.size)
-        graph.adj_list = deepcopy(self.adj_list)
-        graph.vertices = deepcopy(self.vertices)
+        for name in ('lineage', 'vertices', 'ids', 'start', 'end', 'indices', 'twin',
+                     'owner', 'alive', 'scores', 'scored', 'dist', 'sources', 'v_scores',
+                     'max_e_betweenness', 'max_v_betweenness', '_adjacency'):
+            setattr(graph, name, getattr(self, name))
+        self._shared = graph._shared = True
         return graph
 
+    def detach(self):
+        """Take private copies of anything shared with a clone, before writing to it"""
+        if not self._shared:
+            return
+        self.vertices = dict((v, copy(vertex)) for v, vertex in self.vertices.iteritems())
+        self.ids = list(self.ids)
+        for name in ('start', 'end', 'indices', 'twin', 'owner', 'alive', 'scores'):
+            setattr(self, name, getattr(self, name).copy())
+        if self.dist is not None:
+            self.dist = self.dist.copy()
+        self._shared = False
+
+    def _parents_and_children(self, vertex):
+        """
+            Returns:
+            -------
+            (neighbours, parents, children): the ids of the neighbours of
+                vertex, and for each source (row) which of them (column) are
+                one step closer to it than vertex and which one step further
+        """
+        if self.dist is None:
+            raise ValueError("No distance matrix to find pair betweenness from")
+        neighbours = np.unique(self.neighbors(vertex.id))
+        distance = self.dist[:, vertex.id][:, np.newaxis]
+        around = self.dist[:, neighbours]
+        reached = distance >= 0
+        parents = (around == distance - 1) & reached
+        children = (around == distance + 1) & reached
+        return neighbours, parents, children
+
+    def set_split_bound(self, vertex):
+        """
+            Fill in the split bound of vertex from dist: the total of its
+            pair betweennesses, counted per source as its parents times its
+            children without building the matrix of pairs
+        """
+        neighbours, parents, children = self._parents_and_children(vertex)
+        bound = float((parents.sum(axis=1) * children.sum(axis=1)).sum())
+        if self.sources is not None:
+            bound *= len(self.ids) / float(len(self.sources))
+        vertex.split_bound = bound
+
     def set_pair_betweenness(self, vertex):
-        for sp_tree in self.sp_trees:
-            parents = sp_tree.tree_dict[vertex.uuid].parents
-            children = sp_tree.tree_dict[vertex.uuid].children
-            for j in children:
-                for k in parents:
-                    vertex.pair_betweennesses[j.uuid][k.uuid] += 1
-                    vertex.pair_betweennesses[k.uuid][j.uuid] += 1
-        uids = vertex.pair_betweennesses.keys()
-        for i, j in itertools.combinations(uids, 2):
-            if j not in vertex.pair_betweennesses[i].keys():
-                vertex.pair_betweennesses[i][j] = 0
-                vertex.pair_betweennesses[j][i] = 0
+        """
+            Fill in the pair betweennesses of vertex from dist. For each
+            source, vertex lies on the shortest paths from each of its
+            neighbours one step closer to the source (its parents) to each
+            of its neighbours one step further away (its children). Counts
+            from a sample of the sources are scaled up to all of them. dist
+            has to be up to date
+        """
+        neighbours, parents, children = self._parents_and_children(vertex)
+        counts = children.T.astype(float).dot(parents)
+        counts += counts.T
+        if self.sources is not None:
+            counts *= len(self.ids) / float(len(self.sources))
+        used = np.flatnonzero(counts.any(axis=1))
+        vertex.pair_ids = neighbours[used]
+        vertex.pair_betweennesses = counts[np.ix_(used, used)]
+
+    def slot(self, i, j):
+        """
+            Returns:
+            -------
+            the live slot in row i that holds the edge {i, j}
+        """
+        s, e = self.start[i], self.end[i]
+        hits = np.flatnonzero((self.indices[s:e] == j) & self.alive[s:e])
+        return s + hits[0]
 
     def remove_edge(self, i, j, node):
-        del self.adj_list[i][j]
-        del self.adj_list[j][i]
+        self.detach()
+        k = self.slot(i, j)
+        self.alive[k] = False
+        self.alive[self.twin[k]] = False
+        self._changed()
         self.size -= 1
         node.removed_edges += 1
 
+    def subgraph(self, members):
+        """
+            Parameters:
+            ----------
+            members: boolean array over vertex ids, True for the vertices to
+                keep. No live edge may join a kept vertex to a dropped one
+
+            Returns:
+            -------
+            a new Graph holding the kept vertices and their live edges.
+                Since no shortest path crosses between the kept and dropped
+                vertices, up to date scores stay up to date
+        """
+        graph = Graph(0)
+        graph.lineage = self.lineage
+        keep = [position for position, v in enumerate(self.ids) if members[v]]
+        graph.ids = [self.ids[position] for position in keep]
+        graph.vertices = dict((v, Vertex(v)) for v in graph.ids)
+        slots = np.flatnonzero(self.alive & members[self.owner])
+        slots = slots[np.argsort(self.owner[slots], kind='mergesort')]
+        position = np.empty(len(self.indices), dtype=np.intp)
+        position[slots] = np.arange(len(slots))
+        degrees = np.bincount(self.owner[slots], minlength=len(self.start))
+        graph.end = np.cumsum(degrees)
+        graph.start = graph.end - degrees
+        graph.indices = self.indices[slots]
+        graph.twin = position[self.twin[slots]]
+        graph.owner = self.owner[slots]
+        graph.alive = np.ones(len(slots), dtype=bool)
+        graph.scores = self.scores[slots]
+        graph.scored = self.scored
+        if self.sources is not None:
+            # The sample was drawn for the whole graph, so draw afresh
+            graph.scored = False
+        elif self.dist is not None:
+            graph.dist = self.dist[keep]
+        graph.size = len(slots) // 2
+        return graph
+
     def split_graph(self, first_component):
         """
             Parameters:
@@ -124,23 +442,14 @@ class Graph(object):
 
             Returns:
             -------
-            left_list, right_list: each is an adjacency list representing
-                one connected component of the original graph
-        """
-        left = Graph(0)
-        right = Graph(0)
-        for k, v in self.adj_list.iteritems():
-            old_vert = self.vertices[k]
-            if k in first_component:
-                left.adj_list[k] = deepcopy(v)
-                left.vertices[k] = Vertex(old_vert.uid, k)
-                left.size += len(left.adj_list[k])
-            else:
-                right.adj_list[k] = deepcopy(v)
-                right.vertices[k] = Vertex(old_vert.uid, k)
-                right.size += len(right.adj_list[k])
-        right.size, left.size = (right.size / 2, left.size / 2)
-        return left, right
+            left, right: each is a Graph representing one connected
+                component of the original graph
+        """
+        members = np.zeros(len(self.start), dtype=bool)
+        members[self.ids] = True
+        left = np.zeros(len(self.start), dtype=bool)
+        left[list(first_component)] = True
+        return self.subgraph(left), self.subgraph(members & ~left)
 
     def connected_components(self, i, j):
         '''
@@ -151,21 +460,40 @@ class Graph(object):
             Returns
             -------
             (is_connected : boolean) - whether there's a path connecting i to j
-            (components : (list[IDs], list[IDs])) - if there's no path, returns the
+            (components : (Graph, Graph)) - if there's no path, returns the
             two connected components
         '''
-        queue = [i]
-        visited = defaultdict(bool)
-        visited[i] = True
-        while queue:
-            s = queue.pop(0)
-            for child in self.adj_list[s]:
-                if not visited[child]:
-                    if child == j:
-                        return True, []
-                    visited[child] = True
-                    queue.append(child)
-        return False, self.split_graph(visited.keys())
+        is_connected, component = traversal.connected(self.adjacency(), i, j)
+        if is_connected:
+            return True, []
+        return False, self.split_graph(component)
+
+    def component_labels(self):
+        """
+            Returns:
+            -------
+            array indexed by vertex id giving the connected component of
+                each vertex, numbered by the first vertex of each in ids,
+                and -1 for the ids outside the graph
+        """
+        return np.array(traversal.component_labels(self.adjacency(), self.ids),
+                        dtype=np.intp)
+
+    def components(self):
+        """
+            Returns:
+            -------
+            list of Graphs, one per connected component, found in a single
+                pass. The component of the last vertex of ids comes last,
+                and the others in decreasing order of their last vertex
+        """
+        labels = self.component_labels()
+        last = dict((labels[v], position) for position, v in enumerate(self.ids))
+        final = labels[self.ids[-1]] if self.ids else -1
+        order = sorted((c for c in last if c != final), key=last.get, reverse=True)
+        if final >= 0:
+            order.append(final)
+        return [self.subgraph(labels == c) for c in order]
 
     def split_vertex(self, vertex, side_one, side_two):
         """
@@ -179,19 +507,32 @@ class Graph(object):
             -------
             new_id: the new vertex's ID
         """
-        new_id = uuid4()
-        new_vertex = Vertex(vertex.uid, new_id)
-        self.vertices[new_id] = new_vertex
-        self.adj_list[new_id] = {}
-        if isinstance(side_one, Iterable):
-            for v in side_one:
-                del self.adj_list[v][vertex.uuid]
-                del self.adj_list[vertex.uuid][v]
-                self.adj_list[v][new_id] = 0
-                self.adj_list[new_id][v] = 0
-        else:
-            del self.adj_list[side_one][vertex.uuid]
-            del self.adj_list[vertex.uuid][side_one]
-            self.adj_list[side_one][new_id] = 0
-            self.adj_list[new_id][side_one] = 0
+        self.detach()
+        new_id = self.lineage.split(vertex.id)
+        self.vertices[new_id] = Vertex(new_id)
+        if not isinstance(side_one, Iterable):
+            side_one = (side_one,)
+        v, w = vertex.id, new_id
+        if w >= len(self.start):
+            # Rows for every id handed out since this graph was built
+            grow = np.zeros(w + 1 - len(self.start), dtype=np.intp)
+            self.start = np.append(self.start, grow)
+            self.end = np.append(self.end, grow)
+        s, e = self.start[v], self.end[v]
+        moving = np.in1d(self.indices[s:e], list(side_one)) & self.alive[s:e]
+        # Stable partition of the row: the slots that stay, then the ones
+        # that move over to the new vertex
+        order = s + np.concatenate((np.flatnonzero(~moving), np.flatnonzero(moving)))
+        for name in ('indices', 'twin', 'alive', 'scores'):
+            array = getattr(self, name)
+            array[s:e] = array[order]
+        self.twin[self.twin[s:e]] = np.arange(s, e)
+        split = e - np.count_nonzero(moving)
+        self.end[v] = split
+        self.start[w] = split
+        self.end[w] = e
+        self.owner[split:e] = w
+        self.indices[self.twin[split:e]] = w
+        self.ids.append(w)
+        self._changed()
         return new_id
@@ -1,7 +1,6 @@
 from __future__ import division
 from scipy.signal import argrelmax
 from operator import itemgetter
-import itertools
 import numpy as np
 
 
@@ -30,25 +29,78 @@ def find_best_splits(dendrogram, num_total_edges):
 
     '''
     print "\tComputing modularity..."
-    qs = np.ndarray(len(dendrogram.values()))
-    for n, level in enumerate(dendrogram.values()):
-        k = len(level)
-        # Create an empty e matrix.
-        e = np.zeros(shape=(k, k), dtype=float)
-        # Create all pairs of combinations of circles. Since our matrix is symmetric this saves us some time.
-        circleIDs = range(k)
-        all_pairs = itertools.combinations(circleIDs, 2)
-        for (i, j) in all_pairs:
-            node_i = level[i]
-            node_j = level[j]
-            # print "Comparing circle %s and circle %s" % (node_i, node_j)
-            removed_edges = node_i.edge_comparisons[node_j.id]
-            e[i][j] = removed_edges/num_total_edges
-            e[j][i] = removed_edges/num_total_edges
-        for m in xrange(k):
-            e[m][m] = (level[m].graph.size)/num_total_edges
-        qs[n] = calc_modularity(e)
-    return sort_max(qs)[0]
+    tracker = ModularityTracker(num_total_edges)
+    for level_num in sorted(dendrogram):
+        tracker.add_level(dendrogram[level_num])
+    qs = np.array(tracker.qs)
+    best_splits = sort_max(qs)
+    # A dendrogram cut short while modularity was still rising has no
+    # relative maximum
+    return best_splits[0] if best_splits else np.argmax(qs)
+
+
+class ModularityTracker(object):
+    '''
+        Modularity of each level of a dendrogram, computed as the levels are
+        added top down, so that it can be followed while the dendrogram is
+        still being built.
+
+        Off the diagonal, a level's e-matrix e[i][j] is the share of
+        num_total_edges that was removed to split nodes i and j apart, which
+        is the removed_edges of the node where they parted. On the diagonal
+        it is each node's own share of the edges. Each level is represented
+        by the position of every node's parent on the level above, so its
+        matrix is the one above it indexed by those positions in one go,
+        with the entries between the two children of the node that split
+        filled in from its removed_edges.
+
+        Properties:
+        ----------
+        qs: modularity of each level added so far
+        best: highest modularity so far
+    '''
+    def __init__(self, num_total_edges):
+        self.num_total_edges = num_total_edges
+        self.qs = []
+        self.best = -np.inf
+        self._e = np.zeros((1, 1))
+        self._previous = []
+
+    def add_level(self, level):
+        '''
+            Parameters:
+            ----------
+            level: list of the nodes on the next level of the dendrogram. The
+                levels above it must be fully split, as the removed_edges of
+                the one before it are read now
+
+            Returns:
+            -------
+            the modularity of level
+        '''
+        # The root's parent, None, stands in for the single row of the
+        # 1 x 1 matrix the first level is taken from
+        position = dict((node.id, k) for k, node in enumerate(self._previous))
+        position[None] = 0
+        removed = np.array([node.removed_edges for node in self._previous] or [0],
+                           dtype=float) / self.num_total_edges
+        parents = np.array([position[node.parent.id if node.parent else None]
+                            for node in level], dtype=np.intp)
+        siblings = parents[:, np.newaxis] == parents[np.newaxis, :]
+        e = np.where(siblings, removed[parents][:, np.newaxis], self._e[np.ix_(parents, parents)])
+        sizes = np.array([node.graph.size for node in level], dtype=float)
+        np.fill_diagonal(e, sizes / self.num_total_edges)
+        q = calc_modularity(e)
+        np.fill_diagonal(e, 0)
+        self._e = e
+        self._previous = level
+        self.qs.append(q)
+        self.best = max(self.best, q)
+        return q
+
+    def dropped(self, drop):
+        '''Whether the last level's modularity is drop or more below the best'''
+        return bool(self.qs) and self.best - self.qs[-1] >= drop
 
 
 def sort_max(qs):
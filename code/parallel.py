@@ -0,0 +1,86 @@
+from betweenness import edge_betweenness
+from graph import Graph
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+import ctypes
+import numpy as np
+
+# Below this many sources a pass is cheaper to run in-process
+MIN_PARALLEL_SOURCES = 64
+
+_ARRAYS = (('start', ctypes.c_ssize_t, np.intp),
+           ('end', ctypes.c_ssize_t, np.intp),
+           ('indices', ctypes.c_ssize_t, np.intp),
+           ('twin', ctypes.c_ssize_t, np.intp),
+           ('alive', ctypes.c_bool, bool))
+
+# The worker's views over the shared arrays, set up by _attach
+_shared = {}
+
+
+def _views(buffers):
+    return dict((name, np.frombuffer(buffers[name], dtype=dtype))
+                for name, ctype, dtype in _ARRAYS)
+
+
+def _attach(buffers):
+    _shared.update(_views(buffers))
+
+
+def _accumulate(task):
+    """
+        Worker side of SourcePool.edge_betweenness: runs the searches for one
+        chunk of sources over the graph currently in shared memory
+    """
+    rows, slots, sources, hops = task
+    graph = Graph(0)
+    for name, ctype, dtype in _ARRAYS:
+        length = rows if name in ('start', 'end') else slots
+        setattr(graph, name, _shared[name][:length])
+    return edge_betweenness(graph, sources, hops)
+
+
+class SourcePool(object):
+    """
+        Pool of worker processes that split the sources of an edge
+        betweenness pass between them.
+
+        The CSR arrays of the graph being scored are copied into shared
+        memory before each pass, and each worker returns the partial scores
+        and distances of its chunk of sources. Since edge_betweenness sums
+        exactly, adding up the partial scores gives the same result as a
+        single process would.
+
+        Parameters:
+        ----------
+        workers: number of worker processes
+        graph: the largest graph that will be scored. Sizes the shared
+            arrays, allowing for a vertex split per edge
+    """
+    def __init__(self, workers, graph):
+        self.workers = workers
+        capacity = {'start': len(graph.start) + graph.size,
+                    'end': len(graph.start) + graph.size}
+        buffers = dict((name, RawArray(ctype, capacity.get(name, len(graph.indices))))
+                       for name, ctype, dtype in _ARRAYS)
+        self._arrays = _views(buffers)
+        self._pool = Pool(workers, _attach, (buffers,))
+
+    def edge_betweenness(self, graph, sources=None, hops=None):
+        """Same as betweenness.edge_betweenness, spread over the pool"""
+        rows, slots = len(graph.start), len(graph.indices)
+        if sources is None:
+            sources = np.array(graph.ids)
+        if len(sources) < MIN_PARALLEL_SOURCES:
+            return edge_betweenness(graph, sources, hops)
+        for name, array in self._arrays.iteritems():
+            source = getattr(graph, name)
+            array[:len(source)] = source
+        chunks = np.array_split(sources, 2 * self.workers)
+        partials = self._pool.map(_accumulate, [(rows, slots, chunk, hops) for chunk in chunks])
+        scores = np.sum([partial_scores for partial_scores, dist in partials], axis=0)
+        return scores, np.concatenate([dist for partial_scores, dist in partials])
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,108 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import os
+import time
+
+# Trace format -> file extension
+TRACE_FORMATS = {'jsonl': 'jsonl', 'chrome': 'json'}
+
+
+class Profiler(object):
+    """
+        Counts and times the steps of a dendrogram build, level by level.
+        Dendrogram wraps each step in span(), and calls end_level() as each
+        level is finished. With nothing to write to, only the counts and
+        times of the current level are kept, which costs next to nothing.
+
+        Given out, a file, every span and level is written to it as a
+        trace: in the jsonl format one JSON object per line, and in the
+        chrome format as the events of a Chrome trace (chrome://tracing or
+        Perfetto), which is written as a JSON array left open until close(),
+        as those viewers allow, so that the trace of a stalled run can be
+        read as it grows.
+
+        Properties:
+        ----------
+        level: the dendrogram level being built
+        counts, seconds: how many times each step has run on the current
+            level, and the seconds spent in it
+        progress: if set, a line about each level is printed as it is done
+    """
+    def __init__(self, out=None, trace_format='jsonl', progress=False):
+        if trace_format not in TRACE_FORMATS:
+            raise ValueError("Unknown trace format {0}".format(trace_format))
+        self.out = out
+        self.trace_format = trace_format
+        self.progress = progress
+        self.level = 0
+        self.counts = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self._start = time.time()
+        self._level_start = self._start
+        self._separator = '[\n'
+
+    @contextmanager
+    def span(self, name, **args):
+        """Count and time the code run within the with block as a name step"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.counts[name] += 1
+            self.seconds[name] += elapsed
+            if self.out:
+                self._write(name, start, elapsed, args)
+
+    def end_level(self, removed_edges, total_edges):
+        """
+            Record the level just finished, with the number of edges removed
+            so far out of total_edges, and start counting the next one
+        """
+        now = time.time()
+        summary = {'removed_edges': removed_edges, 'total_edges': total_edges,
+                   'progress': removed_edges / float(total_edges) if total_edges else 1.0,
+                   'counts': dict(self.counts), 'seconds': dict(self.seconds)}
+        if self.out:
+            self._write('level', self._level_start, now - self._level_start, summary)
+        if self.progress:
+            print "\tLevel {0}: {1}/{2} edges removed ({3:.1%}), {4} removals, " \
+                "{5} vertex splits, {6:.2f}s".format(
+                    self.level, removed_edges, total_edges, summary['progress'],
+                    self.counts['edge_removal'], self.counts['vertex_split'],
+                    now - self._level_start)
+        self.level += 1
+        self.counts.clear()
+        self.seconds.clear()
+        self._level_start = now
+
+    def _write(self, name, start, elapsed, args):
+        if self.trace_format == 'jsonl':
+            record = dict(args, event=name, level=self.level,
+                          start=start - self._start, seconds=elapsed)
+            self.out.write(json.dumps(record) + '\n')
+        else:
+            # Times are in microseconds, and progress is also shown as a
+            # counter track
+            event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                     'ts': (start - self._start) * 1e6, 'dur': elapsed * 1e6,
+                     'args': dict(args, level=self.level)}
+            self._write_event(event)
+            if name == 'level':
+                self._write_event({'name': 'progress', 'ph': 'C', 'pid': os.getpid(),
+                                   'ts': (start + elapsed - self._start) * 1e6,
+                                   'args': {'removed_edges': args['removed_edges']}})
+        self.out.flush()
+
+    def _write_event(self, event):
+        self.out.write(self._separator + json.dumps(event))
+        self._separator = ',\n'
+
+    def close(self):
+        """Finish the trace and close the file it is written to"""
+        if self.out:
+            if self.trace_format == 'chrome':
+                self.out.write('[]\n' if self._separator == '[\n' else '\n]\n')
+            self.out.close()
+            self.out = None
@@ -1,31 +1,36 @@
-from collections import defaultdict
+from collections import deque
 
 
 class Node(object):
     """
         Node of a ShortestPathTree
 
+        A tree holds a node per reachable vertex and a tree is built per
+        source, so nodes use __slots__ rather than a __dict__ each.
+
         Properties:
         ----------
-        tree: the tree to which this node belongs
-        uuid: the uuid of the vertex this node represents
+        id: the id of the vertex this node represents
         children: list of children of this node
         parents: list of parents of this node
+        slots: dict mapping each parent's id to the graph slot of the edge
+            between that parent and this node
         distance: distance from s, the starting vertex
         weight: the weight of this node in calculating edge betweenness
 
         Methods:
         -------
-        append(child): add child to this node's children, and update the trees'
-            list of leaves accordingly
-        connect(child_id): connect the node with id child_id to this one
+        append(child): add a newly found child to this node's children
+        connect(child, slot): connect child to this one through the edge in
+            graph slot slot
     """
-    def __init__(self, uuid, parents, tree):
-        self.tree = tree
-        self.tree.tree_dict[uuid] = self
-        self.uuid = uuid
+    __slots__ = ('id', 'children', 'parents', 'slots', 'distance', 'weight')
+
+    def __init__(self, vid, parents):
+        self.id = vid
         self.children = []
         self.parents = parents
+        self.slots = {}
         if parents:
             self.distance = parents[0].distance + 1
             self.weight = parents[0].weight
@@ -34,18 +39,13 @@ class Node(object):
             self.weight = 1
 
     def append(self, child):
-        if not self.children:
-            self.tree.leaves.remove(self)
         self.children.append(child)
-        self.tree.leaves.append(child)
 
-    def connect(self, child_id):
-        child = self.tree.tree_dict[child_id]
+    def connect(self, child, slot):
         if child.distance == self.distance + 1:
-            if not self.children:
-                self.tree.leaves.remove(self)
             self.children.append(child)
             child.parents.append(self)
+            child.slots[self.id] = slot
             child.weight += self.weight
 
     def __str__(self):
@@ -54,7 +54,7 @@ class Node(object):
             children += str(child)
             if len(self.children) > 1 + i:
                 children += ", "
-        string = "%s[d:%s, w:%s]" % (self.uuid, self.distance, self.weight)
+        string = "%s[d:%s, w:%s]" % (self.id, self.distance, self.weight)
         if self.children:
             string += " (%s)" % (children)
         return string
@@ -67,28 +67,32 @@ class ShortestPathTree(object):
 
         Properties:
         ----------
-        tree_dict: a dict from vertex uuids to Nodes, allows for quick access
-            to a node
+        tree_dict: a list from vertex ids to Nodes, allows for quick access
+            to a node. None for the vertices the tree doesn't reach
         root: the root of the tree
-        leaves: a list of the leaves of the tree
+        leaves: a list of the leaves of the tree, in the order they were
+            reached
+
+        The tree is grown by a breadth first search over graph, a Graph.
     """
     def __init__(self, start_id, graph):
-        self.tree_dict = {}
-        self.root = Node(start_id, [], self)
-        self.leaves = [self.root]
-        queue = [(start_id, self.root)]
-        visited = defaultdict(bool)
-        visited[start_id] = True
+        adjacency = graph.adjacency()
+        self.tree_dict = nodes = [None] * len(adjacency)
+        self.root = nodes[start_id] = Node(start_id, [])
+        found = [self.root]
+        queue = deque([(start_id, self.root)])
         while queue:
-            s = queue.pop(0)
-            for v in graph[s[0]]:
-                if not visited[v]:
-                    child = Node(v, [s[1]], self)
+            s = queue.popleft()
+            for slot, v in adjacency[s[0]]:
+                if nodes[v] is None:
+                    child = nodes[v] = Node(v, [s[1]])
+                    child.slots[s[1].id] = slot
+                    found.append(child)
                     queue.append((v, child))
                     s[1].append(child)
-                    visited[v] = True
                 else:
-                    s[1].connect(v)
+                    s[1].connect(nodes[v], slot)
+        self.leaves = [node for node in found if not node.children]
 
     def __str__(self):
         return str(self.root)
@@ -0,0 +1,92 @@
+def bfs(adjacency, source, visited):
+    """
+        Breadth first search from source. On CPython 2 a list of flags
+        tests faster than a bytearray or a dict, and a list that is
+        iterated while it grows makes a cheaper queue than a deque.
+
+        Parameters:
+        ----------
+        adjacency: list indexed by vertex id of lists of (slot, neighbour id)
+            pairs, as returned by Graph.adjacency
+        source: vertex id to start from
+        visited: list of flags indexed by vertex id. The search doesn't
+            enter vertices already flagged in it, and flags every vertex it
+            reaches
+
+        Returns:
+        -------
+        list of the vertices reached, in the order they were reached
+    """
+    visited[source] = True
+    order = [source]
+    # order doubles as the queue: iterating over a list visits the items
+    # appended to it along the way
+    for v in order:
+        for k, w in adjacency[v]:
+            if not visited[w]:
+                visited[w] = True
+                order.append(w)
+    return order
+
+
+def component_labels(adjacency, vertices):
+    """
+        Returns:
+        -------
+        list indexed by vertex id giving the connected component of each of
+            vertices, numbered by the first of vertices in each, and -1 for
+            every other id
+    """
+    labels = [-1] * len(adjacency)
+    visited = [False] * len(adjacency)
+    count = 0
+    for v in vertices:
+        if not visited[v]:
+            for w in bfs(adjacency, v, visited):
+                labels[w] = count
+            count += 1
+    return labels
+
+
+def connected(adjacency, i, j):
+    """
+        Bidirectional breadth first search between i and j. The two
+        searches take turns a level at a time, the one with the smaller
+        frontier going next, and stop as soon as they meet, so a path is
+        usually found after exploring far less than the whole component.
+
+        Returns:
+        -------
+        (is_connected, component): component is None if i and j are
+            connected, and otherwise the list of vertices reachable from i
+    """
+    if i == j:
+        return True, None
+    # True flags the vertices reached from i, False those reached from j
+    side_of = [None] * len(adjacency)
+    side_of[i], side_of[j] = True, False
+    reached = {True: [i], False: [j]}
+    frontiers = {True: [i], False: [j]}
+    while frontiers[True] and frontiers[False]:
+        side = len(frontiers[True]) <= len(frontiers[False])
+        frontier = []
+        for v in frontiers[side]:
+            for k, w in adjacency[v]:
+                mark = side_of[w]
+                if mark is None:
+                    side_of[w] = side
+                    frontier.append(w)
+                elif mark is not side:
+                    return True, None
+        reached[side].extend(frontier)
+        frontiers[side] = frontier
+    if not frontiers[True]:
+        return False, reached[True]
+    # j's side ran out first: finish the search from i on its own
+    component = reached[True]
+    for v in component:
+        for k, w in adjacency[v]:
+            if side_of[w] is not True:
+                side_of[w] = True
+                component.append(w)
+    return False, component